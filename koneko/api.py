@@ -1,20 +1,116 @@
 """Handles (almost) all Pixiv API interactions, eg async login, requests"""
 
+import os
+import json
 import queue
 import threading
+from collections.abc import Mapping, Sequence
 
 import funcy
 from pixivpy3 import PixivError, AppPixivAPI
 
+try:
+    import orjson
+except ImportError:  # Optional, only decodes faster
+    orjson = None
+
 from koneko import pure
 
 
+def loads(text):
+    """Decode json (str or bytes), with orjson if it's installed"""
+    return orjson.loads(text) if orjson else json.loads(text)
+
+
+def view(value):
+    """Wrap decoded json objects and arrays in views; anything else as it is"""
+    if isinstance(value, dict):
+        return JsonView(value)
+    if isinstance(value, list):
+        return JsonListView(value)
+    return value
+
+
+class JsonView(Mapping):
+    """
+    Read-only view of a decoded json object, that reads like pixivpy's
+    JsonDict: json['key'], json.get('key') or json.key (None if missing).
+    pixivpy copies every object in a response into a JsonDict while decoding.
+    Here json['key'] is the decoded value as it is (plain dicts and lists,
+    which is all that data.py needs), and only json.key wraps it in a view,
+    so that chains like json.illust.meta_pages still work
+    """
+    __slots__ = ('_json',)
+
+    def __init__(self, json):
+        self._json = json
+
+    def __getitem__(self, key):
+        return self._json[key]
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        return view(self._json.get(attr))
+
+    def __iter__(self):
+        return iter(self._json)
+
+    def __len__(self):
+        return len(self._json)
+
+    def __repr__(self):
+        return f'JsonView({self._json!r})'
+
+
+class JsonListView(Sequence):
+    """Read-only view of a decoded json array, for json.key; see JsonView"""
+    __slots__ = ('_json',)
+
+    def __init__(self, json):
+        self._json = json
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return JsonListView(self._json[index])
+        return view(self._json[index])
+
+    def __len__(self):
+        return len(self._json)
+
+    def __eq__(self, other):
+        """Equal to lists, like pixivpy's arrays (which are lists)"""
+        if isinstance(other, JsonListView):
+            other = other._json
+        return self._json == other
+
+    def __repr__(self):
+        return f'JsonListView({self._json!r})'
+
+
+def parse_json(content):
+    """A response body (bytes) to a JsonView"""
+    return JsonView(loads(content))
+
+
+class LazyAppPixivAPI(AppPixivAPI):
+    """AppPixivAPI, but responses are decoded by parse_json()"""
+    def parse_result(self, req):
+        # The raw bytes: req.text would guess the encoding first, which is slow
+        try:
+            return parse_json(req.content)
+        except Exception as e:  # Same as AppPixivAPI.parse_result
+            raise PixivError(f'parse_json() error: {e}', header=req.headers,
+                             body=req.text)
+
+
 class APIHandler:
     def __init__(self):
         self.api_queue = queue.Queue()
         self.api_thread = threading.Thread(target=self._login)
         self._credentials: 'Dict'
-        self.api: 'AppPixivAPI()'
+        self._api = None
+        self._lock = threading.Lock()
 
     def add_credentials(self, credentials):
         self._credentials = credentials
@@ -25,14 +121,25 @@ class APIHandler:
 
     def await_login(self):
         """Wait for login to finish, then assign PixivAPI session to API"""
-        self.api_thread.join()
-        self.api = self.api_queue.get()
+        with self._lock:  # Downloads use the api from many threads
+            if self._api is None:
+                self.api_thread.join()
+                self._api = self.api_queue.get()
+
+    @property
+    def api(self):
+        """
+        The logged in PixivAPI session. Waits for login if it isn't done yet,
+        so views shown from the cache (--resume) don't have to
+        """
+        self.await_login()
+        return self._api
 
     def _login(self):
         """
         Logins to pixiv in the background, using credentials from config file.
         """
-        api = AppPixivAPI()
+        api = LazyAppPixivAPI()
         api.login(self._credentials['Username'], self._credentials['Password'])
         self.api_queue.put(api)
 
@@ -81,8 +188,8 @@ class APIHandler:
 
     # Download
     @funcy.retry(tries=3, errors=(ConnectionError, PixivError))
-    def protected_download(self, url):
+    def protected_download(self, url, path=os.curdir):
         """Protect api download function with funcy.retry so it doesn't crash"""
-        self.api.download(url)
+        self.api.download(url, path=path)
 
 myapi = APIHandler()
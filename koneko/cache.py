@@ -0,0 +1,534 @@
+"""
+Coordinates access to the cache (KONEKODIR) between koneko instances.
+
+Every page directory (eg KONEKODIR/2232374/1/) has an advisory lock file next
+to it (KONEKODIR/2232374/.1.lock). Downloads hold the lock exclusively and
+write into a staging directory, which is renamed to the page directory only
+when complete, so a page directory is either absent or complete. Renders hold
+the lock shared, so that a reload in another instance can't delete a page
+while it's being displayed.
+
+Page directories rebuilt by refreshing() also hold a manifest (.manifest) of
+the id and url of every file, so that a refresh keeps the files that are
+still valid and only downloads the rest. Files a page drops are kept for a
+while in a pool next to it (KONEKODIR/2232374/.pool/), for the page they've
+moved to.
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import hashlib
+import subprocess
+from contextlib import contextmanager, suppress
+from concurrent.futures import ProcessPoolExecutor
+
+from tqdm import tqdm
+from PIL import Image
+
+from koneko import KONEKODIR
+
+IMAGE_EXTS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+MANIFEST = '.manifest'
+POOL = '.pool'
+POOL_SIZE = 120
+
+
+def _sibling(path, suffix):
+    """KONEKODIR/123/1/ -> KONEKODIR/123/.1{suffix}"""
+    parent, name = os.path.split(str(path).rstrip('/'))
+    return os.path.join(parent, f'.{name}{suffix}')
+
+
+def lock_path(path):
+    return _sibling(path, '.lock')
+
+
+def staging_path(path):
+    return _sibling(path, '.part')
+
+
+def trash_path(path):
+    return _sibling(path, '.trash')
+
+
+@contextmanager
+def page_lock(path, shared=False):
+    """
+    Hold an advisory lock on a page directory until the with block ends.
+    Blocks until every other instance has released a conflicting lock.
+
+    Parameters
+    ----------
+    path : str
+        The page directory to lock; it doesn't need to exist yet
+    shared : bool
+        Shared locks are for reading (rendering), exclusive for writing
+    """
+    lockfile = lock_path(path)
+    os.makedirs(os.path.dirname(lockfile), exist_ok=True)
+    with open(lockfile, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@contextmanager
+def publishing(path):
+    """
+    Lock the page directory, yield a staging directory to download into, then
+    publish it by renaming it to path.
+
+    If another instance has already published path (including while waiting
+    for the lock), yields None instead: reuse their download.
+    """
+    with page_lock(path):
+        if os.path.isdir(path):
+            yield None
+            return
+
+        staging = staging_path(path)
+        shutil.rmtree(staging, ignore_errors=True)  # Left behind by a crash
+        os.makedirs(staging)
+        try:
+            yield staging
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        os.rename(staging, str(path).rstrip('/'))
+
+
+def remove_page(path):
+    """
+    Delete a page directory once no other instance is reading or writing it.
+    It's renamed away first so that it disappears in one step
+    """
+    with page_lock(path):
+        if not os.path.isdir(path):
+            return
+        trash = trash_path(path)
+        shutil.rmtree(trash, ignore_errors=True)
+        os.rename(str(path).rstrip('/'), trash)
+        shutil.rmtree(trash, ignore_errors=True)
+
+
+def remove_all(path):
+    """Delete a directory containing page directories (at any depth)"""
+    pages = [os.path.join(root, name)
+             for (root, dirs, _) in os.walk(path)
+             for name in dirs if name.isdigit()]
+
+    # Deepest first, in case a page directory contains another one
+    for page in sorted(pages, key=len, reverse=True):
+        remove_page(page)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+# - Page manifests
+def read_manifest(path):
+    """
+    What a page directory holds, in the order of the page: a list of
+    {'id', 'url', 'file'}, with file relative to the page directory.
+    Empty if it has no manifest, eg it was downloaded before manifests
+    """
+    try:
+        with open(os.path.join(path, MANIFEST)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+
+def _write_manifest(path, manifest):
+    temp = os.path.join(path, f'{MANIFEST}.part')
+    with open(temp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(temp, os.path.join(path, MANIFEST))
+
+
+def _key(entry):
+    return entry['id'], entry['url']
+
+
+def pool_path(path):
+    """KONEKODIR/123/1/ -> KONEKODIR/123/.pool, shared by the pages of a view"""
+    return os.path.join(os.path.dirname(str(path).rstrip('/')), POOL)
+
+
+def _pool_file(pool, entry):
+    """Pooled files are named by id and url, as their page may change"""
+    digest = hashlib.sha1(entry['url'].encode()).hexdigest()[:16]
+    return os.path.join(pool, f"{entry['id']}_{digest}")
+
+
+def _link(source, target):
+    """
+    Hard link, or copy where the filesystem can't. Returns whether it worked:
+    the source can be gone, eg removed by another instance
+    """
+    try:
+        os.link(source, target)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        try:
+            shutil.copy2(source, target)
+        except OSError:
+            return False
+    return True
+
+
+def _known_files(path):
+    """
+    (id, url): file, for every file in the manifests of the pages of the
+    view that path belongs to; the page at path wins
+    """
+    parent, name = os.path.split(str(path).rstrip('/'))
+    others = [os.path.join(parent, other) for other in os.listdir(parent)
+              if other.isdigit() and other != name]
+    files = {}
+    for page in others + [path]:
+        files.update({_key(entry): os.path.join(page, entry['file'])
+                      for entry in read_manifest(page)})
+    return files
+
+
+def _pool(pool, entries, page):
+    """Keep the files of entries (that page is dropping) in the pool"""
+    os.makedirs(pool, exist_ok=True)
+    for entry in entries:
+        if not os.path.exists(_pool_file(pool, entry)):
+            _link(os.path.join(page, entry['file']), _pool_file(pool, entry))
+
+    pooled = sorted(os.scandir(pool), key=lambda entry: entry.stat().st_ctime)
+    for entry in pooled[:-POOL_SIZE]:
+        with suppress(FileNotFoundError):
+            os.remove(entry.path)
+
+
+@contextmanager
+def refreshing(path, manifest):
+    """
+    Rebuild a page directory to hold manifest (like read_manifest's), keeping
+    files that have the same id and url, even if their position changed.
+
+    They're taken from the page directory itself, the other pages of the same
+    view (eg a post deleted shifts them back by one), and the view's pool.
+    The files that the page drops are kept in the pool (up to POOL_SIZE), for
+    the page they've moved to (eg a new post shifts them on by one).
+
+    Yields (staging, missing): the entries of manifest to download into
+    staging. The rest are linked into it already. Once the with block ends,
+    the manifest is written (without the entries whose file isn't there, so
+    the next refresh downloads them) and staging replaces the page directory.
+    If the with block raises, the page directory is left as it was.
+    If the page directory holds manifest already (eg another instance has
+    just refreshed it), yields (None, []) instead
+    """
+    with page_lock(path):
+        current = read_manifest(path)
+        if current == manifest and os.path.isdir(path):
+            yield None, []
+            return
+        files = _known_files(path)
+        pool = pool_path(path)
+
+        staging = staging_path(path)
+        shutil.rmtree(staging, ignore_errors=True)
+        os.makedirs(staging)
+        missing = []
+        try:
+            for entry in manifest:
+                target = os.path.join(staging, entry['file'])
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                source = files.get(_key(entry))
+                if not ((source and _link(source, target))
+                        or _link(_pool_file(pool, entry), target)):
+                    missing.append(entry)
+            yield staging, missing
+        except BaseException:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+        _write_manifest(staging, [
+            entry for entry in manifest
+            if os.path.isfile(os.path.join(staging, entry['file']))])
+
+        kept = set(map(_key, manifest))
+        dropped = [entry for entry in current if _key(entry) not in kept]
+        if dropped:
+            _pool(pool, dropped, path)
+        # Swap it in: the old directory is renamed away first, like remove_page
+        trash = trash_path(path)
+        shutil.rmtree(trash, ignore_errors=True)
+        if os.path.isdir(path):
+            os.rename(str(path).rstrip('/'), trash)
+        os.rename(staging, str(path).rstrip('/'))
+        shutil.rmtree(trash, ignore_errors=True)
+
+
+def forget_files(page, filepaths):
+    """
+    Delete files from a page directory that has a manifest, and their entries
+    from it, so that the next refresh downloads only them. Returns whether
+    the page has a manifest
+    """
+    with page_lock(page):
+        manifest = read_manifest(page)
+        if not manifest:
+            return False
+        for filepath in filepaths:
+            with suppress(FileNotFoundError):
+                os.remove(filepath)
+        _write_manifest(page, [
+            entry for entry in manifest
+            if os.path.isfile(os.path.join(page, entry['file']))])
+        return True
+
+
+# - Integrity check
+def check_image(filepath):
+    """
+    Returns the reason why the file is broken, or None if it's a valid image.
+    JPEGs are decoded at reduced scale (draft mode) which still reads the
+    whole file, so truncated files are caught without paying for a full decode
+    """
+    if os.path.getsize(filepath) == 0:
+        return 'empty file'
+    try:
+        with Image.open(filepath) as image:
+            if image.format == 'JPEG':
+                image.draft('RGB', (64, 64))
+                image.load()
+            else:
+                image.verify()
+    except Exception as err:  # PIL raises all sorts for bad files
+        return f'{type(err).__name__}: {err}'
+    return None
+
+
+def check_numbering(filenames, from_zero=True):
+    """
+    Files in page directories are prefixed with their position in the
+    download (pure.prefix_filename), so the prefixes must be consecutive.
+    They start from 0, except in previews/ where they continue on from the
+    profile pics (from_zero=False). Returns the missing positions
+    """
+    prefixes = [name.split('_')[0] for name in filenames]
+    if not prefixes or not all(len(p) == 3 and p.isdigit() for p in prefixes):
+        return []  # Not a page directory
+    prefixes = set(map(int, prefixes))
+    start = 0 if from_zero else min(prefixes)
+    return sorted(set(range(start, max(prefixes) + 1)) - prefixes)
+
+
+def _check_dir(path):
+    """Check every image in one directory. Runs in a worker process"""
+    images = sorted(entry.name for entry in os.scandir(path)
+                    if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTS))
+    broken = [(os.path.join(path, name), reason)
+              for name in images
+              if (reason := check_image(os.path.join(path, name)))]
+
+    if is_page_dir(path):
+        broken += [(os.path.join(path, f'{str(number).rjust(3, "0")}_*'),
+                    'missing file')
+                   for number in check_numbering(
+                       images, from_zero=os.path.basename(path) != 'previews')]
+    return broken
+
+
+def is_page_dir(path):
+    """
+    Page directories (and their previews/ subdirectory) are named by number.
+    individual/{image_id}/ is also numbered, but holds a multi-image post
+    """
+    path = str(path).rstrip('/')
+    if os.path.basename(path) == 'previews':
+        path = os.path.dirname(path)
+    return (os.path.basename(path).isdigit()
+            and os.path.basename(os.path.dirname(path)) != 'individual')
+
+
+def _page_dir(path):
+    """The page directory that path (a directory) belongs to, or None"""
+    path = str(path).rstrip('/')
+    if not is_page_dir(path):
+        return None
+    if os.path.basename(path) == 'previews':
+        path = os.path.dirname(path)
+    return path
+
+
+def _walk(path):
+    """os.walk, without descending into hidden (staging and trash) directories"""
+    for (root, dirs, files) in os.walk(path):
+        hidden = [name for name in dirs if name.startswith('.')]
+        dirs[:] = [name for name in dirs if not name.startswith('.')]
+        yield root, hidden, files
+
+
+def _stale_leftovers(path):
+    """Staging and trash directories whose page isn't locked by anyone"""
+    for (root, hidden, _) in _walk(path):
+        for name in hidden:
+            if not name.endswith(('.part', '.trash')):
+                continue
+            page = os.path.join(root, name[1:].rsplit('.', 1)[0])
+            with open(lock_path(page), 'a') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:  # Still in use
+                    continue
+                fcntl.flock(f, fcntl.LOCK_UN)
+            yield os.path.join(root, name)
+
+
+def check(path=KONEKODIR, repair=True, workers=None):
+    """
+    Validate every cached image under path, using a pool of worker processes
+    (one directory per task).
+
+    Broken files in page directories with a manifest are deleted along with
+    their entries, so that only they are downloaded again the next time the
+    page is visited (it no longer matches). Pages downloaded before manifests
+    are removed as a whole instead, as nothing would notice the missing
+    files. Elsewhere (large/ and individual/), the broken file is deleted and
+    downloaded again when viewed.
+
+    Returns a list of (filepath, reason)
+    """
+    dirs = [root for (root, _, files) in _walk(path) if files]
+    leftovers = list(_stale_leftovers(path))
+
+    broken = []
+    with ProcessPoolExecutor(workers) as executor:
+        results = executor.map(_check_dir, dirs, chunksize=16)
+        for result in tqdm(results, total=len(dirs), smoothing=0):
+            broken += result
+
+    if repair:
+        for leftover in leftovers:
+            shutil.rmtree(leftover, ignore_errors=True)
+
+        pages = {}
+        for (filepath, _) in broken:
+            if page := _page_dir(os.path.dirname(filepath)):
+                pages.setdefault(page, []).append(filepath)
+        for (page, filepaths) in pages.items():
+            if not forget_files(page, filepaths):
+                remove_page(page)
+        for (filepath, _) in broken:
+            if not _page_dir(os.path.dirname(filepath)) and os.path.isfile(filepath):
+                os.remove(filepath)
+
+    return [(leftover, 'stale download') for leftover in leftovers] + broken
+
+
+# - Recompression
+def _idle_priority():
+    """Worker initializer: only use the CPU when nothing else wants it"""
+    os.nice(19)
+    if hasattr(os, 'SCHED_IDLE'):
+        os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+
+
+def recompress_image(filepath, quality):
+    """
+    Re-encode one image to WebP in place, keeping its filename so that nothing
+    that refers to it needs to change (PIL and kitty detect the format from
+    the contents, not the extension).
+    The new file is written next to it and renamed over it, so readers see
+    either the old or the new file. Returns the number of bytes saved.
+    Animated images (eg ugoira gifs) are left as they are
+    """
+    old_size = os.path.getsize(filepath)
+    with Image.open(filepath) as image:
+        if image.format == 'WEBP' or getattr(image, 'is_animated', False):
+            return 0
+        image.load()
+        temp = _sibling(filepath, '.webp.part')
+        image.save(temp, format='WEBP', quality=quality, method=6)
+
+    new_size = os.path.getsize(temp)
+    if new_size >= old_size:
+        os.remove(temp)
+        return 0
+    os.replace(temp, filepath)
+    return old_size - new_size
+
+
+def _compress_dir(path, quality, cold_before):
+    """
+    Recompress the cold images in one directory. Runs in a worker process.
+    Page directories are locked so that other instances don't see half of
+    a page recompressed
+    """
+    page = _page_dir(path)
+    images = [entry.path for entry in os.scandir(path)
+              if entry.is_file()
+              and entry.name.lower().endswith(IMAGE_EXTS)
+              and max(entry.stat().st_atime, entry.stat().st_mtime) < cold_before]
+    if not images:
+        return 0
+
+    def recompress_all():
+        saved = 0
+        for filepath in images:
+            try:
+                saved += recompress_image(filepath, quality)
+            except (OSError, ValueError):  # Broken image; cache check's job
+                pass
+        return saved
+
+    if page:
+        with page_lock(page):
+            if os.path.isdir(path):  # Might have been removed while waiting
+                return recompress_all()
+            return 0
+    return recompress_all()
+
+
+def compress(path=KONEKODIR, quality=80, cold_days=7, workers=None,
+             progress=True):
+    """
+    Re-encode cached images that haven't been used for cold_days to WebP,
+    in a pool of idle priority worker processes. Only one instance of this job
+    runs at a time; returns the number of bytes saved, or None if another
+    instance is already running.
+    """
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, '.compress.lock'), 'a') as f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+
+        cold_before = time.time() - cold_days * 24 * 60 * 60
+        dirs = [root for (root, _, files) in _walk(path) if files]
+        with ProcessPoolExecutor(workers, initializer=_idle_priority) as executor:
+            results = executor.map(_compress_dir, dirs,
+                                   [quality] * len(dirs),
+                                   [cold_before] * len(dirs),
+                                   chunksize=16)
+            if progress:
+                results = tqdm(results, total=len(dirs), smoothing=0)
+            return sum(results)
+
+
+def compress_in_background(quality=80, cold_days=7):
+    """
+    Run `koneko cache compress` as a separate, detached process, so it can
+    carry on after koneko exits and never writes to the terminal
+    """
+    subprocess.Popen(
+        [sys.executable, '-m', 'koneko.main', 'cache', 'compress',
+         f'--quality={quality}', f'--days={cold_days}'],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
@@ -8,6 +8,9 @@ Usage:
   koneko (3|f) <link_or_id>
   koneko [4|s] <searchstr>
   koneko [5|n]
+  koneko cache check [--dry-run]
+  koneko cache compress [--quality=<q>] [--days=<d>]
+  koneko --resume
   koneko -h
 
 Notes:
@@ -15,6 +18,13 @@ Notes:
    otherwise your link would default to mode 1.
 *  It is assumed you won't need to search for an artist named '5' or 'n' from the
    command line, because it would go to mode 5.
+*  `cache check` validates every cached image, and removes broken ones so that
+   they will be downloaded again. It doesn't need to log in.
+*  `cache compress` re-encodes cached images that haven't been viewed for a
+   while to WebP. It can also be run in the background automatically, by
+   setting `compress = on` in the [Cache] section of the config file.
+*  `--resume` goes back to where you were when koneko last exited, shown from the
+   cache without waiting to log in. Without a saved session, it starts normally.
 
 Optional arguments (for specifying a mode):
   1 a  Mode 1 (Artist gallery)
@@ -29,16 +39,33 @@ Required arguments if a mode is specified:
   <searchstr>   String to search for artists
 
 Options:
-  -h  Show this help
+  -h             Show this help
+  --resume       Go back to the view koneko was last in
+  --dry-run      Only report broken cached images, don't remove them
+  --quality=<q>  WebP quality to re-encode cached images with [default: 80]
+  --days=<d>     Only re-encode images not viewed for this many days [default: 7]
 """
 
 import sys
 from docopt import docopt
 from koneko import pure
 
+def process_cache_args():
+    """
+    Commands that manage the cache don't need to log in, so they are handled
+    before anything else. Returns the parsed arguments, or None if not given
+    """
+    args = docopt(__doc__)
+    if not args['cache']:
+        return None
+    return args
+
+def process_resume_arg():
+    return docopt(__doc__)['--resume']
+
 def process_cli_args():
     args = docopt(__doc__)
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 1 and not args['--resume']:
         print('Logging in...')
         prompted = False
     else:  # No cli arguments
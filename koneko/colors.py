@@ -30,7 +30,7 @@ def _two_letter_with_coords(letter):
                     Fore.MAGENTA, letter.upper(), _blue_n, Fore.RED, ']', Fore.RESET])
 
 
-_letters = ['n', 'p', 'r', 'q', 'm', 'b', 'o', 'd']
+_letters = ['n', 'p', 'r', 'q', 'm', 'b', 'o', 'd', 'f', 'g']
 _tlc = ['a', 'o', 'd']
 
 # Public
@@ -38,7 +38,7 @@ _tlc = ['a', 'o', 'd']
 coords = ''.join([Fore.RED, '{', Fore.BLUE, 'x', Fore.RED, '}{', Fore.BLUE,
                   'y', Fore.RED, '}', Fore.RESET])
 
-n, p, r, q, m, b, o_, d_ = list(map(_letter, _letters))
+n, p, r, q, m, b, o_, d_, f, g = list(map(_letter, _letters))
 
 i = _letter_with_coords('i')
 
@@ -55,6 +55,7 @@ base1 = [
 base2 = [
     n, 'ext page; ',
     p, 'revious page;\n',
+    f, 'ilter the illusts seen so far; ',
     r, 'eload and re-download all; ',
     q, 'uit (with confirmation); ',
 ]
@@ -1,18 +1,294 @@
 """Stores json data from the api. Acts as frontend to access data in a single line.
 Functionally pure, no side effects (but stores state)
 """
+from array import array
+from collections import OrderedDict
+
 from koneko import KONEKODIR, pure
 
+# The image url sizes that koneko uses, in the order Illust stores them
+SIZES = ('square_medium', 'medium', 'large')
+
+
+def _urls(json):
+    return tuple(json['image_urls'].get(size) for size in SIZES)
+
+
+class Illust:
+    """
+    The fields of a post that koneko uses, kept instead of its whole json
+    (caption, tags, stats, ...). It can still be read like the json, eg
+    illust['image_urls']['large'] or illust['user']['id'], so it can be
+    passed to anything that takes a post's json
+    """
+    __slots__ = ('id', 'title', 'user_id', 'page_count', '_urls', '_page_urls')
+
+    def __init__(self, json):
+        self.id = json['id']
+        self.title = json['title']
+        self.user_id = json['user']['id']
+        self.page_count = json['page_count']
+        self._urls = _urls(json)
+        self._page_urls = tuple(map(_urls, json['meta_pages']))
+
+    def __getitem__(self, key):
+        if key == 'user':
+            return {'id': self.user_id}
+        if key == 'image_urls':
+            return dict(zip(SIZES, self._urls))
+        if key == 'meta_pages':
+            return [{'image_urls': dict(zip(SIZES, urls))}
+                    for urls in self._page_urls]
+        if key in ('id', 'title', 'page_count'):
+            return getattr(self, key)
+        raise KeyError(key)
+
+
+class PageCache:
+    """
+    A dict of pages that only keeps the max_pages most recently used ones in
+    memory (pinned ones included), so memory stays flat however many pages
+    are visited.
+    Evicted pages are fetched again with refetch(key) when they're next used,
+    so it reads as if it held every page ever stored: `in`, keys() and len()
+    include evicted pages. Without refetch, nothing is evicted.
+    Pages in pinned are never evicted
+    """
+    def __init__(self, refetch=None, max_pages=8, pinned=()):
+        self._pages = OrderedDict()
+        self._known = {}  # Every key stored, in order (a dict as an ordered set)
+        self._refetch = refetch
+        self._max_pages = max_pages
+        self._pinned = set(pinned)
+
+    def __setitem__(self, key, page):
+        self._pages[key] = page
+        self._pages.move_to_end(key)
+        self._known[key] = None
+        self._evict()
+
+    def __getitem__(self, key):
+        if key in self._pages:
+            self._pages.move_to_end(key)
+            return self._pages[key]
+        if key not in self._known or not self._refetch:
+            raise KeyError(key)
+        page = self._refetch(key)
+        self[key] = page
+        return page
+
+    def __contains__(self, key):
+        return key in self._known
+
+    def __len__(self):
+        return len(self._known)
+
+    def keys(self):
+        return self._known.keys()
+
+    def in_memory(self):
+        return list(self._pages)
+
+    def stored(self):
+        """The pages in memory by key, without marking them as used"""
+        return dict(self._pages)
+
+    def add_known(self, keys):
+        """Keys of pages that aren't in memory, but that refetch can get"""
+        self._known.update(dict.fromkeys(keys))
+
+    def clear(self):
+        """Forget every page except the pinned ones"""
+        for key in list(self._known):
+            if key not in self._pinned:
+                del self._known[key]
+                self._pages.pop(key, None)
+
+    def _evict(self):
+        if not self._refetch:
+            return
+        evictable = [key for key in self._pages if key not in self._pinned]
+        for key in evictable[:max(0, len(self._pages) - self._max_pages)]:
+            del self._pages[key]
+
+
+class GalleryPage:
+    """One page of posts, read like the json: page['illusts'], page['next_url']"""
+    __slots__ = ('illusts', 'next_url')
+
+    def __init__(self, json):
+        self.illusts = list(map(Illust, json['illusts']))
+        self.next_url = json['next_url']
+
+    def __getitem__(self, key):
+        if key in self.__slots__:
+            return getattr(self, key)
+        raise KeyError(key)
+
+
+class IllustTable:
+    """
+    Metadata of every illust seen in a session, across all pages, stored by
+    column in flat arrays. Filtering and sorting thousands of illusts is then
+    a scan over a few arrays instead of over nested json, and needs no api
+    calls.
+    Tags are stored as ids (tag_names[id] is the name), all in one array;
+    the tags of row i are _tags[_tag_starts[i]:_tag_starts[i + 1]]
+    """
+    SORT_KEYS = ('bookmarks', 'pages', 'id')
+
+    def __init__(self):
+        self.ids = array('q')
+        self.user_ids = array('q')
+        self.pages = array('l')  # The gallery page it's on
+        self.positions = array('l')  # Its number on that page
+        self.page_counts = array('l')
+        self.bookmarks = array('q')
+        self.titles = []
+        self.tag_names = []
+        self._tag_ids = {}
+        self._tags = array('l')
+        self._tag_starts = array('q', [0])
+        self._seen = set()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, page_num, illusts):
+        """Add the illusts (json) on a page; ones already seen are skipped"""
+        for (position, illust) in enumerate(illusts):
+            if illust['id'] in self._seen:
+                continue
+            self._seen.add(illust['id'])
+            self.ids.append(illust['id'])
+            self.user_ids.append(illust['user']['id'])
+            self.pages.append(page_num)
+            self.positions.append(position)
+            self.page_counts.append(illust['page_count'])
+            self.bookmarks.append(illust.get('total_bookmarks', 0))
+            self.titles.append(illust['title'])
+            self._tags.extend(self._tag_id(tag['name'])
+                              for tag in illust.get('tags', ()))
+            self._tag_starts.append(len(self._tags))
+
+    def _tag_id(self, name):
+        if name not in self._tag_ids:
+            self._tag_ids[name] = len(self.tag_names)
+            self.tag_names.append(name)
+        return self._tag_ids[name]
+
+    def tags(self, row):
+        start, end = self._tag_starts[row], self._tag_starts[row + 1]
+        return [self.tag_names[tag] for tag in self._tags[start:end]]
+
+    def select(self, multi_page=False, min_bookmarks=0, tags=(), user_id=None):
+        """
+        Rows that meet every condition. A tag matches every tag name that
+        contains it (ignoring case)
+        """
+        rows = range(len(self))
+        if multi_page:
+            rows = [row for row in rows if self.page_counts[row] > 1]
+        if min_bookmarks:
+            rows = [row for row in rows if self.bookmarks[row] >= min_bookmarks]
+        if user_id is not None:
+            rows = [row for row in rows if self.user_ids[row] == user_id]
+        for tag in tags:
+            wanted = {tag_id for (tag_id, name) in enumerate(self.tag_names)
+                      if tag.lower() in name.lower()}
+            rows = [row for row in rows
+                    if not wanted.isdisjoint(
+                        self._tags[self._tag_starts[row]:self._tag_starts[row + 1]])]
+        return list(rows)
+
+    def sort(self, rows, key='bookmarks'):
+        """Sort rows by a column in SORT_KEYS, largest first"""
+        column = {'bookmarks': self.bookmarks, 'pages': self.page_counts,
+                  'id': self.ids}[key]
+        return sorted(rows, key=column.__getitem__, reverse=True)
 
-class GalleryJson:
-    """Stores data for gallery modes (mode 1 and 5)"""
-    def __init__(self, raw):
-        self.raw = raw
-        self.all_pages_cache = {'1': self.raw}
-        self.current_page_illusts = self.raw['illusts']
 
+class GalleryJson:
+    """
+    Stores data for gallery modes (mode 1 and 5)
+
+    Parameters
+    ========
+    fetch : function
+        fetch(next_url) requests the page at next_url from the api again,
+        after it's been evicted from all_pages_cache (keeps max_pages pages).
+        The first page is always kept, as it has no next_url
+    """
+    def __init__(self, raw, fetch=None, max_pages=8):
+        self._setup(fetch, max_pages)
+        self.add_page(1, raw)
+        self._first_page()
+
+    @classmethod
+    def restore(cls, saved, fetch=None, max_pages=8):
+        """
+        Rebuild from a session.Saved of snapshot(). Pages are read from it
+        only when they're used
+        """
+        gdata = cls.__new__(cls)
+        gdata._setup(fetch, max_pages, saved)
+        gdata._sources = saved.state['sources']
+        gdata.all_pages_cache.add_known(saved.state['pages'])
+        gdata._first_page()
+        return gdata
+
+    def _setup(self, fetch, max_pages, saved=None):
+        self._fetch = fetch
+        self._saved = saved
+        self._sources = {}  # Page number: the next_url that it comes from
+        self._table = None if saved else IllustTable()
+        self.all_pages_cache = PageCache(self._refetch if fetch or saved else None,
+                                         max_pages, pinned=('1',))
+
+    def _first_page(self):
+        self.current_page_illusts = self.current_illusts()
         self.titles = pure.post_titles_in_page(self.current_page_illusts)
 
+    def snapshot(self):
+        """
+        (state, sections) for session.save; every page and the table are
+        sections of their own
+        """
+        state = {'sources': self._sources,
+                 'pages': list(self.all_pages_cache.keys())}
+        sections = {'table': self.table}
+        in_memory = self.all_pages_cache.stored()
+        for key in self.all_pages_cache.keys():
+            # Pages not read since restoring are carried over
+            if page := in_memory.get(key) or self._saved_page(key):
+                sections[f'page {key}'] = page
+        return state, sections
+
+    @property
+    def table(self):
+        if self._table is None:
+            self._table = self._saved.section('table')
+        return self._table
+
+    def add_page(self, page_num, raw):
+        """Store the api response for a page, keeping only what's used"""
+        page = GalleryPage(raw)
+        self.all_pages_cache[str(page_num)] = page
+        self.table.add(page_num, raw['illusts'])
+        self._sources[str(page_num + 1)] = page.next_url
+
+    def _saved_page(self, page_num):
+        if self._saved and f'page {page_num}' in self._saved:
+            return self._saved.section(f'page {page_num}')
+        return None
+
+    def _refetch(self, page_num):
+        if page := self._saved_page(page_num):
+            return page
+        if not self._fetch:
+            raise KeyError(page_num)
+        return GalleryPage(self._fetch(self._sources[page_num]))
+
     def current_page(self, current_page_num=1):
         return self.all_pages_cache[str(current_page_num)]
 
@@ -54,6 +330,10 @@ class ImageJson:
             # So it won't be duplicated later
             self.large_dir = f'{KONEKODIR}/{self.artist_user_id}/individual/{image_id}/'
 
+    def record(self):
+        """The post, as a compact Illust"""
+        return Illust(self._raw)
+
     def image_filename(self):
         return self.downloaded_images[self.img_post_page_num]
 
@@ -68,21 +348,46 @@ class ImageJson:
 
 
 class UserJson:
-    """Stores data for user views (modes 3 and 4)"""
-    def __init__(self, raw, page_num):
-        self.ids_cache, self.names_cache = {}, {}
+    """
+    Stores data for user views (modes 3 and 4)
+    fetch(page_num) requests a page from the api again, after it's been
+    evicted from pages_cache (keeps max_pages pages)
+    """
+    def __init__(self, raw, page_num, fetch=None, max_pages=8):
+        self._fetch = fetch
+        # Page number: (artist ids, artist names)
+        self.pages_cache = PageCache(self._refetch if fetch else None, max_pages)
         self.update(raw, page_num)
 
-    def update(self, raw, page_num):
-        self.raw = raw
-        self.next_url = self.raw['next_url']
-        page = self.raw['user_previews']
+    @classmethod
+    def restore(cls, state, fetch=None, max_pages=8):
+        """Rebuild from what snapshot() returned"""
+        udata = cls.__new__(cls)
+        udata._fetch = fetch
+        udata.pages_cache = PageCache(udata._refetch if fetch else None, max_pages)
+        udata.pages_cache.add_known(state['pages'])
+        for (page_num, page) in state['in_memory'].items():
+            udata.pages_cache[page_num] = page
+        udata.next_url = state['next_url']
+        udata.profile_pic_urls = state['profile_pic_urls']
+        udata.image_urls = state['image_urls']
+        udata.image_ids = state.get('image_ids', [])
+        return udata
+
+    def snapshot(self):
+        """State for session.save (artist ids and names are small)"""
+        return {'pages': list(self.pages_cache.keys()),
+                'in_memory': self.pages_cache.stored(),
+                'next_url': self.next_url,
+                'profile_pic_urls': self.profile_pic_urls,
+                'image_urls': self.image_urls,
+                'image_ids': self.image_ids}
 
-        ids = list(map(self._user_id, page))
-        self.ids_cache.update({page_num: ids})
-
-        names = list(map(self._user_name, page))
-        self.names_cache.update({page_num: names})
+    def update(self, raw, page_num):
+        """Keeps only what's used from the api response, not the response"""
+        self.next_url = raw['next_url']
+        page = raw['user_previews']
+        self.pages_cache[page_num] = self._ids_and_names(page)
 
         self.profile_pic_urls = list(map(self._user_profile_pic, page))
 
@@ -91,12 +396,20 @@ class UserJson:
         self.image_urls = [page[i]['illusts'][j]['image_urls']['square_medium']
                            for i in range(len(page))
                            for j in range(len(page[i]['illusts']))]
+        self.image_ids = [illust['id'] for artist in page
+                          for illust in artist['illusts']]
+
+    def _refetch(self, page_num):
+        return self._ids_and_names(self._fetch(page_num)['user_previews'])
+
+    def _ids_and_names(self, page):
+        return (tuple(map(self._user_id, page)), tuple(map(self._user_name, page)))
 
     def artist_user_id(self, page_num, selected_user_num):
-        return self.ids_cache[page_num][selected_user_num]
+        return self.pages_cache[page_num][0][selected_user_num]
 
     def names(self, page_num):
-        return self.names_cache[page_num]
+        return list(self.pages_cache[page_num][1])
 
     def all_urls(self):
         return self.profile_pic_urls + self.image_urls
@@ -109,6 +422,17 @@ class UserJson:
     def splitpoint(self):
         return len(self.profile_pic_urls)
 
+    def manifest(self, page_num):
+        """
+        What the page's directory holds (for cache.refreshing): the profile
+        pics by user id, then the previews (in previews/) by illust id.
+        """
+        ids = list(self.pages_cache[page_num][0]) + self.image_ids
+        return [pure.manifest_entry(id_, url, name, number,
+                                    '' if number < self.splitpoint() else 'previews/')
+                for (number, (id_, url, name))
+                in enumerate(zip(ids, self.all_urls(), self.all_names(page_num)))]
+
     @staticmethod
     def _user_id(json):
         return json['user']['id']
@@ -5,7 +5,7 @@ from concurrent.futures import ThreadPoolExecutor
 
 import cytoolz
 
-from koneko import api, pure, utils
+from koneko import api, pure, utils, cache
 
 
 @pure.spinner('')
@@ -21,10 +21,14 @@ def async_download_spinner(download_path, urls, rename_images=False,
     )
 
 def async_download_core(download_path, urls, rename_images=False,
-                        file_names=None, pbar=None):
+                        file_names=None, pbar=None, on_done=None):
     """
     Rename files with given new name if needed.
     Submit each url to the ThreadPoolExecutor, so download and rename are concurrent
+    on_done, if given, is called with the absolute path of every file once it
+    has been downloaded and renamed (from the downloading threads)
+    Doesn't change the working directory, as downloads can run in the
+    background (ui.Prefetch) while other threads use it
     """
     oldnames = list(map(pure.split_backslash_last, urls))
     if rename_images:
@@ -33,18 +37,41 @@ def async_download_core(download_path, urls, rename_images=False,
     else:
         newnames = oldnames
 
-    filtered = itertools.filterfalse(os.path.isfile, newnames)
-    oldnames = itertools.filterfalse(os.path.isfile, oldnames)
-    helper = downloadr(pbar=pbar)
+    def exists(name):
+        return os.path.isfile(os.path.join(download_path, name))
+
+    filtered = itertools.filterfalse(exists, newnames)
+    oldnames = itertools.filterfalse(exists, oldnames)
+    helper = downloadr(pbar=pbar, on_done=on_done, download_path=download_path)
     os.makedirs(download_path, exist_ok=True)
-    with pure.cd(download_path):
-        with ThreadPoolExecutor(max_workers=len(urls)) as executor:
-            executor.map(helper, urls, oldnames, filtered)
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        executor.map(helper, urls, oldnames, filtered)
+
+def download_files(download_path, urls, filepaths, pbar=None, on_done=None):
+    """
+    Download urls concurrently into filepaths (relative to download_path, and
+    maybe in a subdirectory of it), eg the files a page directory is missing
+    (cache.refreshing). on_done is like async_download_core's.
+    Once they've all finished, the first download that failed is re-raised
+    """
+    if not urls:
+        return
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        jobs = []
+        for (url, filepath) in zip(urls, filepaths):
+            folder, name = os.path.split(os.path.join(download_path, filepath))
+            os.makedirs(folder, exist_ok=True)
+            jobs.append(executor.submit(downloadr, url, pure.split_backslash_last(url),
+                                        name, pbar=pbar, on_done=on_done,
+                                        download_path=folder))
+    for job in jobs:
+        job.result()
 
 @cytoolz.curry
-def downloadr(url, img_name, new_file_name=None, pbar=None):
-    """Actually downloads one pic given one url, rename if needed."""
-    api.myapi.protected_download(url)
+def downloadr(url, img_name, new_file_name=None, pbar=None, on_done=None,
+              download_path=os.curdir):
+    """Actually downloads one pic given one url into download_path, rename if needed."""
+    api.myapi.protected_download(url, download_path)
 
     if pbar:
         pbar.update(1)
@@ -53,20 +80,44 @@ def downloadr(url, img_name, new_file_name=None, pbar=None):
         # This character break renames
         if '/' in new_file_name:
             new_file_name = new_file_name.replace('/', '')
-        os.rename(img_name, new_file_name)
+        os.rename(os.path.join(download_path, img_name),
+                  os.path.join(download_path, new_file_name))
 
+    if on_done:
+        on_done(os.path.abspath(os.path.join(download_path,
+                                             new_file_name or img_name)))
 
-def download_page(current_page_illusts, download_path, pbar=None):
+
+def download_page(current_page_illusts, download_path, pbar=None, on_done=None):
     """
     Download the illustrations on one page of given artist id (using threads),
     rename them based on the *post title*. Used for gallery modes (1 and 5)
+    The page is rebuilt with cache.refreshing: illustrations already in the
+    cache (on any page of the view) are kept, and only the rest downloaded.
+    It's only published to download_path when it is complete (a failed
+    download is re-raised, and the page is left as it was); if another
+    instance is downloading the same page, wait for it and reuse its download
+    on_done is called for every file as it lands (see async_download_core), then
+    with None just before the page is published
     """
-    urls = pure.medium_urls(current_page_illusts)
-    titles = pure.post_titles_in_page(current_page_illusts)
-
-    async_download_core(
-        download_path, urls, rename_images=True, file_names=titles, pbar=pbar
-    )
+    manifest = pure.page_manifest(current_page_illusts)
+
+    with cache.refreshing(download_path, manifest) as (staging, missing):
+        if not staging:
+            return
+        try:
+            for entry in manifest:
+                if entry not in missing and on_done:
+                    on_done(os.path.abspath(os.path.join(staging, entry['file'])))
+            if pbar:
+                pbar.update(len(manifest) - len(missing))
+            download_files(staging,
+                           [entry['url'] for entry in missing],
+                           [entry['file'] for entry in missing],
+                           pbar=pbar, on_done=on_done)
+        finally:
+            if on_done:
+                on_done(None)  # Last chance to use the files in staging
 
 
 # - Wrappers around the core functions for downloading one image
@@ -75,10 +126,9 @@ def download_core(large_dir, url, filename, try_make_dir=True):
     """Downloads one url, intended for single images only"""
     if try_make_dir:
         os.makedirs(large_dir, exist_ok=True)
-    if not Path(filename).is_file():
+    if not Path(large_dir, filename).is_file():
         print('   Downloading illustration...', flush=True, end='\r')
-        with pure.cd(large_dir):
-            downloadr(url, filename, None)
+        downloadr(url, filename, None, download_path=large_dir)
 
 
 def download_image_verified(image_id=None, post_json=None, png=False, **kwargs):
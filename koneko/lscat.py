@@ -2,15 +2,44 @@
 The default image renderer for koneko.
 """
 
+import io
 import os
+import re
+import math
+import mmap
+import sys
+import threading
+import json
+import zlib
+import queue
+import shutil
+import base64
 import fnmatch
+import hashlib
+import tempfile
 from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 
 import funcy
 import cytoolz
-from pixcat import Image
+from pixcat.terminal import TERM
+from PIL import Image as PILImage
 
-from koneko.pure import cd
+from koneko import KONEKODIR
+from koneko.pure import CLEAR
+
+ESC = '\x1b'
+CHUNK_SIZE = 4096
+
+# How images are sent: as PNG, as zlib compressed pixels, or as whichever of
+# the two is smaller. Over ssh, the bytes on the wire cost more than the time
+# spent compressing, so that's the default there
+PAYLOADS = ('png', 'zlib', 'smallest')
+REMOTE = any(var in os.environ for var in ('SSH_CONNECTION', 'SSH_CLIENT', 'SSH_TTY'))
+PAYLOAD = 'smallest' if REMOTE else 'png'
 
 
 # - Pure functions
@@ -21,8 +50,7 @@ def is_image(myfile):
 
 
 def filter_jpg(path):
-    with cd(path):
-        return sorted(filter(is_image, os.listdir('.')))
+    return sorted(filter(is_image, os.listdir(path)))
 
 
 @cytoolz.curry
@@ -34,15 +62,782 @@ def number_prefix(myfile):
     return int(myfile.split('_')[0])
 
 
+def page_cells(page, rowspaces, cols, left_shifts, path):
+    """
+    Flattens a page (tuple of rows of files) into (filepath, x, y) tuples,
+    where x and y are in terminal cells, in row order. Padding from
+    cytoolz.partition (None rows) and short last rows are skipped
+    """
+    return [(os.path.join(path, row[col]), left_shifts[col], rowspaces[index])
+            for (index, row) in enumerate(page) if row
+            for col in cols if col < len(row)]
+
+
+def shift_cells(cells, rows):
+    """Move cells (from page_cells()) down by rows"""
+    return [(myfile, x, y + rows) for (myfile, x, y) in cells]
+
+
+def fit_within(size, box):
+    """
+    The largest size with the same aspect ratio as size that fits in box
+    (both are (width, height)), never enlarging, like kitty +kitten icat
+    """
+    (width, height), (max_width, max_height) = size, box
+    scale = min(1, max_width / width, max_height / height)
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def fit(image, size):
+    """Scale image up or down so that its longest side == size, like pixcat"""
+    width, height = image.size
+    if max(width, height) == size:
+        return image
+    scale = size / max(width, height)
+    new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return image.resize(new_size, PILImage.LANCZOS)
+
+
+def thumbnail(myfile, size=310):
+    """Decode an image and fit it into size, ready to be composited"""
+    return fit(PILImage.open(myfile), size).convert('RGBA')
+
+
+def make_atlas(cells, cell_px, size=310):
+    """
+    Composites every image in cells into a single transparent image, keeping
+    the same relative positions as if they were displayed one by one.
+
+    Parameters
+    ========
+    cells : list of (str, int, int)
+        Filepath and x, y coordinates (in terminal cells), from page_cells()
+    cell_px : tuple of ints
+        Width and height of one terminal cell, in pixels
+    size : int
+        Size of each thumbnail
+
+    Returns
+    ========
+    The composited image, and the x, y coordinates (cells) to place it at
+    """
+    thumbs = [thumbnail(myfile, size) for (myfile, _, _) in cells]
+    return composite(thumbs, cells, cell_px)
+
+
+def composite(thumbs, cells, cell_px):
+    """make_atlas(), given thumbnails that have already been made"""
+    cell_w, cell_h = cell_px
+    x0 = min(x for (_, x, _) in cells)
+    y0 = min(y for (_, _, y) in cells)
+
+    offsets = [((x - x0) * cell_w, (y - y0) * cell_h) for (_, x, y) in cells]
+
+    width = max(left + thumb.width for ((left, _), thumb) in zip(offsets, thumbs))
+    height = max(top + thumb.height for ((_, top), thumb) in zip(offsets, thumbs))
+
+    atlas = PILImage.new('RGBA', (width, height), (0, 0, 0, 0))
+    for (thumb, offset) in zip(thumbs, offsets):
+        atlas.paste(thumb, offset)
+    return atlas, x0, y0
+
+
+def cell_size():
+    """Terminal cell size in pixels, or None if it can't be queried (not a tty)"""
+    try:
+        size = TERM.cell_px_size
+    except (OSError, ValueError, ZeroDivisionError):
+        return None
+    return size if all(size) else None
+
+
+def place(x, y):
+    """
+    Move the cursor to column x and row y of the screen (0-based).
+    If y is None, stay on the current row
+    """
+    if y is None:
+        return f'{ESC}[{x + 1}G'
+    return f'{ESC}[{x + 1}G{ESC}[{y + 1}d'
+
+
+def graphics_code(payload='', **controls):
+    """One kitty graphics protocol escape code"""
+    keys = ','.join(f'{key}={value}' for (key, value) in controls.items())
+    return f'{ESC}_G{keys};{payload}{ESC}\\'
+
+
+def transmit(data, **controls):
+    """
+    Transmit data directly (base64 encoded in the escape codes themselves,
+    split into chunks of 4096 bytes), rather than through a temporary file
+    like pixcat. The terminal deletes temporary files after reading them, and
+    direct codes can be stored and written again later.
+    The controls only go in the first chunk
+    """
+    encoded = base64.standard_b64encode(data).decode('ascii')
+    chunks = [encoded[i:i + CHUNK_SIZE]
+              for i in range(0, len(encoded), CHUNK_SIZE)] or ['']
+    last = len(chunks) - 1
+    return ''.join(
+        graphics_code(chunk, **(controls if i == 0 else {}), m=int(i != last))
+        for (i, chunk) in enumerate(chunks)
+    )
+
+
+def encode_png(image, level=1):
+    with io.BytesIO() as buf:
+        image.save(buf, format='PNG', compress_level=level)
+        return buf.getvalue()
+
+
+def encode_pixels(image, level=6):
+    """
+    The raw pixels compressed with zlib (o=z), as RGB (f=24), or as RGBA (f=32)
+    if the image has transparency. Returns the data and its controls
+    """
+    if image.mode not in ('RGB', 'RGBA'):
+        has_alpha = 'A' in image.getbands() or 'transparency' in image.info
+        image = image.convert('RGBA' if has_alpha else 'RGB')
+    controls = {'f': 32 if image.mode == 'RGBA' else 24,
+                's': image.width, 'v': image.height, 'o': 'z'}
+    return zlib.compress(image.tobytes(), level), controls
+
+
+def encode(image, payload):
+    """The data to transmit image as, and its controls. payload is in PAYLOADS"""
+    if payload == 'png':
+        return encode_png(image), {'f': 100}
+    pixels = encode_pixels(image)
+    if payload == 'zlib':
+        return pixels
+    png = encode_png(image, level=6), {'f': 100}
+    return min(pixels, png, key=lambda encoded: len(encoded[0]))
+
+
+def file_key(myfile):
+    """Identifies a file's contents: replaced files get a different key"""
+    stat = os.stat(myfile)
+    return (str(myfile), stat.st_size, stat.st_mtime_ns)
+
+
+def image_id(*parts):
+    """A stable kitty image id (32 bit, non-zero) for the given parts"""
+    digest = hashlib.sha1(repr(parts).encode()).digest()
+    return int.from_bytes(digest[:4], 'big') or 1
+
+
+def placement(image_id, x, y):
+    """Escape codes to display an image the terminal already holds at (x, y)"""
+    return ''.join([place(x, y), graphics_code(a='p', i=image_id, q=2), '\n'])
+
+
+def show(image, image_id, x, y, payload=None):
+    """
+    Escape codes to display image with its top left corner at (x, y), like
+    pixcat.Image.show(align='left', x=x, y=y). q=2 stops kitty from replying,
+    so there's no need to wait for an answer.
+    payload defaults to PAYLOAD
+    """
+    data, controls = encode(image, payload or PAYLOAD)
+    return ''.join([
+        place(x, y),
+        transmit(data, a='T', **controls, i=image_id, q=2),
+        '\n',
+    ])
+
+
+def display_page(output, cells, size=310):
+    """Display every image in cells separately"""
+    for (myfile, x, y) in cells:
+        output.image(image_id(file_key(myfile), size), x, y,
+                     lambda myfile=myfile: fit(PILImage.open(myfile), size))
+
+
+def display_atlas(output, cells, cell_px, size=310):
+    """
+    Transmit and place all images in cells at once. Every thumbnail is made
+    in a separate worker; compositing waits for them in another worker
+    """
+    if not cells:
+        return
+    x0 = min(x for (_, x, _) in cells)
+    y0 = min(y for (_, _, y) in cells)
+    # Only relative positions change the atlas, so it can be placed elsewhere
+    atlas_id = image_id([(file_key(myfile), x - x0, y - y0)
+                         for (myfile, x, y) in cells], cell_px)
+
+    if output.holds(atlas_id):
+        output.image(atlas_id, x0, y0, None)
+        return
+
+    thumbs = [POOL.submit(thumbnail, myfile, size) for (myfile, _, _) in cells]
+    output.image(atlas_id, x0, y0, lambda: composite(
+        [thumb.result() for thumb in thumbs], cells, cell_px
+    )[0])
+
+
+def line(*args):
+    """The same text as print(*args)"""
+    return ' '.join(map(str, args)) + '\n'
+
+
+# Column numbers below the gallery, for the prompt
+COLUMN_LABELS = line(' ' * 8, 1, ' ' * 15, 2, ' ' * 15, 3, ' ' * 15, 4,
+                     ' ' * 15, 5, '\n')
+
+
+def prepare(make_image, image_id, x, y):
+    """
+    The expensive part of displaying an image (decode, resize, encode and
+    compress), done in a worker. Returns the escape codes and the image's size in memory
+    """
+    image = make_image()
+    return show(image, image_id, x, y), image.width * image.height * 4
+
+
 # Impure functions
-@funcy.ignore(IndexError, TypeError)
-def display_page(page, rowspaces, cols, left_shifts, path):
-    with cd(path):
-        for (index, space) in enumerate(rowspaces):
-            for col in cols:
-                Image(page[index][col]).thumbnail(310).show(
-                    align='left', x=left_shifts[col], y=space
-                )
+# Workers to prepare images with. PIL releases the GIL while decoding,
+# resizing and compressing, so threads are enough.
+# Jobs that wait for other jobs (compositing an atlas) are always submitted
+# after the jobs they wait for, so they can't block a worker that those jobs
+# need: when a waiting job is running, every job before it has started
+POOL = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+
+class ImageRegistry:
+    """
+    Keeps track of the images that have been transmitted to the terminal
+    (by id), and roughly how much memory each takes there, so that images it
+    already holds only need to be placed again.
+    Once over quota, the least recently used images are deleted from the
+    terminal (including their data), to stay below its storage limit.
+    """
+    def __init__(self, quota=256 * 2**20):
+        self._quota = quota
+        self._images = OrderedDict()  # id: size in bytes
+        self._total = 0
+
+    def __contains__(self, image_id):
+        return image_id in self._images
+
+    def holds_all(self, image_ids):
+        return all(image_id in self._images for image_id in image_ids)
+
+    def use(self, image_id):
+        self._images.move_to_end(image_id)
+
+    def size(self, image_id):
+        return self._images[image_id]
+
+    def add(self, image_id, size, keep=()):
+        """
+        Register a transmitted image; returns the codes to evict old ones.
+        The images in keep (the ones the current frame places) aren't evicted
+        """
+        self._total += size - self._images.get(image_id, 0)
+        self._images[image_id] = size
+        self._images.move_to_end(image_id)
+
+        evictions = []
+        for old_id in list(self._images):
+            if self._total <= self._quota:
+                break
+            if old_id == image_id or old_id in keep:
+                continue
+            self._total -= self._images.pop(old_id)
+            evictions.append(graphics_code(a='d', d='I', i=old_id, q=2))
+        return ''.join(evictions)
+
+
+REGISTRY = ImageRegistry()
+
+
+def write(text):
+    """Write to the terminal in one go"""
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+
+class Output:
+    """
+    The output of a render, in two stages:
+        1. A render adds text and images in order. Images are prepared in
+           parallel in POOL, as soon as they're added
+        2. emit() writes everything in order, only waiting for each image to
+           be ready when it's next in line
+
+    It's recorded so that it can be stored. Two versions are recorded: in full
+    (transmitting every image) for when the terminal doesn't hold the images,
+    and with placements only for when it does
+    """
+    def __init__(self):
+        self._ops = []  # text, or (image_id, x, y, future or None)
+        self._full = []
+        self._placements = []
+        self.sizes = {}  # image id: size in bytes
+        # False if any image was only placed, so the full version is unknown
+        self.complete = True
+
+    def holds(self, image_id):
+        """If the terminal will hold the image by the time it's displayed"""
+        return image_id in REGISTRY or image_id in self.sizes
+
+    def write(self, text):
+        self._ops.append(text)
+
+    def image(self, image_id, x, y, make_image):
+        """
+        Display the image given by image_id at (x, y). make_image() is only
+        called (in a worker) if the terminal doesn't already hold it
+        """
+        if image_id in self.sizes:  # Transmitted earlier in this render
+            self._ops.append((image_id, x, y, None))
+            return
+        if image_id in REGISTRY:  # Transmitted by an earlier render
+            self.sizes[image_id] = REGISTRY.size(image_id)
+            self.complete = False
+            self._ops.append((image_id, x, y, None))
+            return
+
+        self.sizes[image_id] = None  # Set when ready
+        self._ops.append(
+            (image_id, x, y, POOL.submit(prepare, make_image, image_id, x, y))
+        )
+
+    def emit(self, before=''):
+        """
+        Write everything added so far out in order, as one frame: it's
+        buffered and written at once, so the terminal gets a single write
+        (one packet over ssh, no flicker) however many images there are.
+        More can be added and emitted afterwards, for renders that are shown
+        as they go. before is written first, but isn't recorded
+        """
+        ops, self._ops = self._ops, []
+        frame = [before]
+        for op in ops:
+            if isinstance(op, str):
+                self._full.append(op)
+                self._placements.append(op)
+                frame.append(op)
+                continue
+
+            (image_id, x, y, future) = op
+            self._placements.append(placement(image_id, x, y))
+            if future is None:  # Already held
+                with funcy.suppress(KeyError):
+                    REGISTRY.use(image_id)
+                self._full.append(placement(image_id, x, y))
+                frame.append(placement(image_id, x, y))
+                continue
+
+            codes, size = future.result()
+            self._full.append(codes)
+            self.sizes[image_id] = size
+            frame.append(REGISTRY.add(image_id, size, keep=self.sizes) + codes)
+        write(''.join(frame))
+
+    def full(self):
+        return ''.join(self._full) if self.complete else None
+
+    def placements(self):
+        return ''.join(self._placements)
+
+
+class StreamCache:
+    """
+    Stores the fully encoded output of renders on disk, so that showing the
+    same page again only needs to write the stored stream back out, instead
+    of decoding, resizing and encoding every image again.
+
+    Streams are keyed by the files (and their sizes and modification times,
+    so replaced files aren't reused), the layout parameters and the terminal
+    geometry. The least recently used streams are removed once the total size
+    exceeds max_bytes.
+
+    Each entry holds the image sizes (a json line), the stream with placements
+    only, and the full stream (separated by a null byte, which never appears
+    in escape codes), if known.
+    """
+    def __init__(self, directory=KONEKODIR / '.streams', max_bytes=256 * 2**20):
+        self._directory = Path(directory)
+        self._max_bytes = max_bytes
+
+    @staticmethod
+    def key(files, layout):
+        hasher = hashlib.sha1(repr(layout).encode())
+        for myfile in files:
+            hasher.update(repr(file_key(myfile)).encode())
+        return hasher.hexdigest()
+
+    def get(self, key):
+        """Returns (sizes, placements, full or None), or None if not stored"""
+        path = self._directory / key
+        try:
+            entry = path.read_text(encoding='utf-8')
+        except FileNotFoundError:
+            return None
+        os.utime(path)  # Mark as recently used
+
+        header, _, streams = entry.partition('\n')
+        placements, _, full = streams.partition('\0')
+        sizes = {int(image_id): size
+                 for (image_id, size) in json.loads(header).items()}
+        return sizes, placements, full or None
+
+    def put(self, key, sizes, placements, full=None):
+        self._directory.mkdir(parents=True, exist_ok=True)
+        temp = self._directory / f'.{key}.{os.getpid()}'
+        temp.write_text(
+            '\n'.join([json.dumps(sizes), placements]) + '\0' + (full or ''),
+            encoding='utf-8'
+        )
+        os.replace(temp, self._directory / key)
+        self._prune()
+
+    def _prune(self):
+        entries = sorted((entry for entry in os.scandir(self._directory)
+                          if not entry.name.startswith('.')),  # Being written
+                         key=lambda entry: entry.stat().st_mtime, reverse=True)
+        total = 0
+        for entry in entries:
+            total += entry.stat().st_size
+            if total > self._max_bytes:
+                with funcy.suppress(FileNotFoundError):
+                    os.remove(entry.path)
+
+
+STREAMS = StreamCache()
+
+
+def show_single(filepath, clear=False, margin_rows=3):
+    """
+    Display one image, fitted to the window and centered, at the cursor,
+    like `kitty +kitten icat` but without starting another process.
+    Goes through the same Output as the views, so an image that the terminal
+    already holds is only placed again.
+
+    Parameters
+    ========
+    clear : bool
+        Clear the screen first, so the image is at the top
+    margin_rows : int
+        Rows to leave free below the image, for the prompt
+    """
+    with PILImage.open(filepath) as image:
+        size = image.size
+
+    cell_px, geometry = cell_size(), terminal_geometry()
+    if cell_px and geometry:
+        ((cols, rows), (px_width, px_height)) = geometry
+        size = fit_within(size, (px_width, px_height - margin_rows * cell_px[1]))
+        x = max(0, (cols - math.ceil(size[0] / cell_px[0])) // 2)
+    else:
+        x = 0
+
+    output = Output()
+    if clear:
+        output.write(CLEAR)
+    output.image(image_id(file_key(filepath), size), x, None,
+                 lambda: rendition(filepath, size))
+    output.emit()
+
+
+def rendition_path(filepath, size):
+    """
+    Where the rendition of filepath at size (width, height) is cached. It's
+    in the format of the original: JPEG if it's a JPEG, otherwise PNG
+    """
+    directory, name = os.path.split(str(filepath))
+    ext = '.jpg' if os.path.splitext(name)[1].lower() in ('.jpg', '.jpeg') else '.png'
+    return os.path.join(directory, '.display', f'{name}.{size[0]}x{size[1]}{ext}')
+
+
+def rendition(filepath, size):
+    """
+    filepath resized to size, for display. Originals can be far larger than
+    the window (4000x6000), so the resized image is cached next to it in
+    .display/ (a hidden dir, which cache maintenance skips), and it's only
+    decoded and resized again if the window size changes or the original is
+    replaced. Only the last size is kept; the original isn't touched.
+    Runs in a worker
+    """
+    path = rendition_path(filepath, size)
+    with funcy.suppress(OSError):
+        if os.path.getmtime(path) >= os.path.getmtime(filepath):
+            with PILImage.open(path) as image:
+                image.load()
+                return image
+
+    with PILImage.open(filepath) as image:
+        if image.size == size:  # Nothing to save
+            image.load()
+            return image
+        image.draft('RGB', size)  # Decode JPEGs at reduced scale
+        resized = image.resize(size, PILImage.LANCZOS)
+
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    # Names come from post titles, which can have glob characters
+    previous = re.compile(re.escape(os.path.basename(str(filepath))) + r'\.\d+x\d+\.\w+')
+    for old in filter(previous.fullmatch, os.listdir(directory)):
+        with funcy.suppress(FileNotFoundError):
+            os.remove(os.path.join(directory, old))
+
+    temp = f'{path}.{os.getpid()}.{threading.get_ident()}'
+    if path.endswith('.jpg') and resized.mode in ('RGB', 'L', 'CMYK'):
+        resized.save(temp, format='JPEG', quality=90)
+    else:
+        resized.save(temp, format='PNG', compress_level=1)
+    os.replace(temp, path)  # Other instances see the whole file, or none
+    return resized
+
+
+def terminal_geometry():
+    """Terminal size in cells and in pixels, or None if not a tty"""
+    try:
+        return TERM.size, TERM.px_size
+    except (OSError, ValueError):
+        return None
+
+
+class Tiles:
+    """
+    A tiled pyramid of one (large) image, for zooming and panning. Level 0 is
+    the full size image, and every level above is half the size of the one
+    below it.
+
+    A level is made only once, the first time it's needed, and cut into tiles
+    of tile_px that are stored losslessly (PNG) next to the image in .tiles/
+    (a hidden dir, which cache maintenance skips). Level 0 is decoded into a
+    memory-mapped scratch file rather than memory (_full_size), and every
+    level above is made from the tiles of the one below, so only a few tiles
+    are in memory at a time. After that only the tiles in view are read, and
+    the last max_tiles of them are kept in memory, so memory stays bounded
+    however large the image is.
+    """
+    # Modes that PIL can decode into a mapped buffer (core.map_buffer)
+    MAPPED_MODES = {'RGB': 4, 'RGBA': 4, 'L': 1}
+
+    def __init__(self, filepath, tile_px=512, max_tiles=64):
+        self._filepath = str(filepath)
+        self._tile_px = tile_px
+        self._max_tiles = max_tiles
+        self._cache = OrderedDict()  # (level, col, row): tile
+
+        with PILImage.open(filepath) as image:
+            self.size = image.size
+        directory, name = os.path.split(self._filepath)
+        stamp = os.stat(filepath).st_mtime_ns  # Replaced images get new tiles
+        self._directory = os.path.join(directory, '.tiles',
+                                       f'{name}.{stamp}.{tile_px}')
+
+    def level_size(self, level):
+        width, height = self.size
+        return -(-width // 2**level), -(-height // 2**level)
+
+    def _tile_path(self, level, col, row):
+        return os.path.join(self._directory, str(level), f'{col}_{row}')
+
+    @contextmanager
+    def _full_size(self):
+        """
+        The image at full size. It's decoded into a scratch file mapped into
+        memory, so the pixels are in pages that the kernel can write out
+        rather than in koneko's memory. Modes that can't be (eg palette
+        images) are decoded in memory
+        """
+        with PILImage.open(self._filepath) as image:
+            pixel_bytes = self.MAPPED_MODES.get(image.mode)
+            if not pixel_bytes or 'transparency' in image.info:
+                image.load()
+                yield image.convert('RGBA' if 'A' in image.getbands()
+                                    or 'transparency' in image.info else 'RGB')
+                return
+
+            length = image.size[0] * image.size[1] * pixel_bytes
+            with tempfile.TemporaryFile(dir=self._directory) as scratch:
+                scratch.truncate(length)
+                with mmap.mmap(scratch.fileno(), length) as buffer:
+                    # load() decodes into the image memory that's already set
+                    image.im = PILImage.core.map_buffer(
+                        buffer, image.size, 'raw', 0, (image.mode, 0, 1))
+                    try:
+                        image.load()
+                        yield image
+                    finally:
+                        image.im = None  # Lets the mmap close
+
+    def _cut(self, image, directory):
+        """Store level 0 as tiles, a tile at a time"""
+        step = self._tile_px
+        width, height = image.size
+        for top in range(0, height, step):
+            for left in range(0, width, step):
+                tile = image.crop((left, top, min(left + step, width),
+                                   min(top + step, height)))
+                tile.save(os.path.join(directory, f'{left // step}_{top // step}'),
+                          format='PNG', compress_level=1)
+
+    def _halve(self, level, directory):
+        """Store level from the tiles of the level below, 2x2 of them per tile"""
+        step = self._tile_px
+        below_width, below_height = self.level_size(level - 1)
+        width, height = self.level_size(level)
+        for row in range(-(-height // step)):
+            for col in range(-(-width // step)):
+                box = (2 * col * step, 2 * row * step,
+                       min(2 * (col + 1) * step, below_width),
+                       min(2 * (row + 1) * step, below_height))
+                quad = None
+                for (i, j) in ((0, 0), (1, 0), (0, 1), (1, 1)):
+                    left, top = box[0] + i * step, box[1] + j * step
+                    if left >= box[2] or top >= box[3]:
+                        continue
+                    with PILImage.open(self._tile_path(level - 1, 2 * col + i,
+                                                       2 * row + j)) as below:
+                        below.load()
+                        if quad is None:
+                            quad = PILImage.new(below.mode, (box[2] - box[0],
+                                                             box[3] - box[1]))
+                        quad.paste(below, (left - box[0], top - box[1]))
+                tile = quad.resize((min(step, width - col * step),
+                                    min(step, height - row * step)), PILImage.LANCZOS)
+                tile.save(os.path.join(directory, f'{col}_{row}'),
+                          format='PNG', compress_level=1)
+
+    def _make_level(self, level):
+        """Store a level as tiles. Several can race to do this"""
+        if level and not os.path.isdir(os.path.join(self._directory, str(level - 1))):
+            self._make_level(level - 1)
+
+        os.makedirs(self._directory, exist_ok=True)
+        temp = os.path.join(self._directory,
+                            f'.{level}.{os.getpid()}.{threading.get_ident()}')
+        os.makedirs(temp)
+        try:
+            if level:
+                self._halve(level, temp)
+            else:
+                with self._full_size() as image:
+                    self._cut(image, temp)
+        except BaseException:
+            shutil.rmtree(temp, ignore_errors=True)
+            raise
+        try:
+            os.rename(temp, os.path.join(self._directory, str(level)))
+        except OSError:  # Made by someone else in the meantime
+            shutil.rmtree(temp, ignore_errors=True)
+
+    def tile(self, level, col, row):
+        key = (level, col, row)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        if not os.path.isdir(os.path.join(self._directory, str(level))):
+            self._make_level(level)
+        with PILImage.open(self._tile_path(level, col, row)) as tile:
+            tile.load()
+
+        self._cache[key] = tile
+        while len(self._cache) > self._max_tiles:
+            self._cache.popitem(last=False)
+        return tile
+
+    def view(self, level, box):
+        """
+        The part of a level inside box (left, top, right, bottom, in the
+        pixels of that level), made from the tiles that it overlaps
+        """
+        left, top, right, bottom = box
+        step = self._tile_px
+        view = None
+        for row in range(top // step, -(-bottom // step)):
+            for col in range(left // step, -(-right // step)):
+                tile = self.tile(level, col, row)
+                if view is None:
+                    view = PILImage.new(tile.mode, (right - left, bottom - top))
+                view.paste(tile, (col * step - left, row * step - top))
+        return view
+
+
+class Zoom:
+    """
+    Zoom into one image and pan around it, one screen at a time. Each screen
+    is made from the Tiles in view, in a worker, and transmitted as a single
+    image of at most the window's size; screens that the terminal still holds
+    are only placed again.
+    Needs the terminal size in pixels (check with Zoom.available())
+
+    Parameters
+    ========
+    margin_rows : int
+        Rows to leave free below the image, for the prompt
+    """
+    def __init__(self, filepath, margin_rows=3):
+        self._filepath = filepath
+        self._tiles = Tiles(filepath)
+        self._cell_px = cell_size()
+        ((self._cols, _), (px_width, px_height)) = terminal_geometry()
+        self._window = (px_width, px_height - margin_rows * self._cell_px[1])
+
+        # The highest level that doesn't fit is the first one zoomed in;
+        # the one above it fits, which is what show_single() does
+        self.fit_level = 0
+        while not self._fits(self.fit_level):
+            self.fit_level += 1
+        self.level = max(self.fit_level - 1, 0)
+        width, height = self._tiles.size
+        self._center = (width / 2, height / 2)  # In level 0 pixels
+
+    @staticmethod
+    def available():
+        return bool(cell_size() and terminal_geometry())
+
+    def _fits(self, level):
+        width, height = self._tiles.level_size(level)
+        return width <= self._window[0] and height <= self._window[1]
+
+    def zoomed(self):
+        """False if zoomed out to where the whole image fits"""
+        return self.level < self.fit_level
+
+    def zoom(self, steps):
+        """Zoom in by steps levels (out if negative), keeping the center"""
+        self.level = min(max(self.level - steps, 0), self.fit_level)
+
+    def pan(self, right, down):
+        """Move by a quarter of the window, in each direction given"""
+        scale = 2**self.level
+        x, y = self._center
+        self._center = (x + right * self._window[0] * scale / 4,
+                        y + down * self._window[1] * scale / 4)
+
+    def box(self):
+        """The part of the current level in view, with the center kept inside"""
+        scale = 2**self.level
+        level_width, level_height = self._tiles.level_size(self.level)
+        width = min(self._window[0], level_width)
+        height = min(self._window[1], level_height)
+
+        x, y = self._center
+        left = min(max(round(x / scale - width / 2), 0), level_width - width)
+        top = min(max(round(y / scale - height / 2), 0), level_height - height)
+        # So that panning past an edge doesn't need to be undone
+        self._center = ((left + width / 2) * scale, (top + height / 2) * scale)
+        return left, top, left + width, top + height
+
+    def render(self):
+        level, box = self.level, self.box()
+        width = box[2] - box[0]
+        x = max(0, (self._cols - math.ceil(width / self._cell_px[0])) // 2)
+
+        output = Output()
+        output.write(CLEAR)
+        output.image(image_id(file_key(self._filepath), level, box), x, None,
+                     lambda: self._tiles.view(level, box))
+        output.emit()
 
 
 class View(ABC):
@@ -57,12 +852,14 @@ class View(ABC):
                                 this.
     Hence, the need to plot each row of images in order
     """
-    def __init__(self, path, number_of_columns, rowspaces, page_spaces, rows_in_page):
+    def __init__(self, path, number_of_columns, rowspaces, page_spaces,
+                 rows_in_page, atlas):
         self._path = path
         self._number_of_columns = number_of_columns
         self._rowspaces = rowspaces
         self._page_spaces = page_spaces
         self._rows_in_page = rows_in_page
+        self._atlas = atlas
 
         self._cols = range(self._number_of_columns)
         total_width = 90
@@ -86,8 +883,93 @@ class View(ABC):
         assert len(self._pages_list[0]) <= len(self._rowspaces) == self._rows_in_page
         assert len(self._pages_list) <= len(self._page_spaces)
 
-    @abstractmethod
+    def _cell_px(self):
+        """Atlas mode needs the cell size to composite; fall back if unknown"""
+        if not self._atlas:
+            return None
+        return cell_size()
+
+    def _display_cells(self, output, cells, cell_px):
+        if not cell_px:
+            display_page(output, cells)
+        elif self._atlas == 'row':
+            # Group cells by their y coordinate
+            for row in cytoolz.groupby(2, cells).values():
+                display_atlas(output, row, cell_px)
+        else:
+            display_atlas(output, cells, cell_px)
+
+    def _display_page(self, output, page, cell_px):
+        cells = page_cells(page, self._rowspaces, self._cols, self._left_shifts,
+                           self._path)
+        self._display_cells(output, cells, cell_px)
+
+    @property
+    def number_of_pages(self):
+        return len(self._pages_list)
+
+    def page_rows(self, image_rows):
+        """Rows one page takes up in a Viewport, given the rows of one image"""
+        return self._rowspaces[self._rows_in_page - 1] + image_rows
+
+    def draw_page(self, output, i, top):
+        """Display page i with its top at row `top` of the screen, for a Viewport"""
+        cells = page_cells(self._pages_list[i], self._rowspaces, self._cols,
+                           self._left_shifts, self._path)
+        self._display_cells(output, shift_cells(cells, top), self._cell_px())
+
+    def _layout(self):
+        """Everything other than the files that changes the output"""
+        return (type(self).__name__, self._number_of_columns, self._rowspaces,
+                self._page_spaces, self._rows_in_page, self._atlas,
+                terminal_geometry(), PAYLOAD)
+
+    def _files(self):
+        return [os.path.join(self._path, myfile)
+                for page in self._pages_list for row in page if row
+                for myfile in row]
+
     def render(self):
+        """
+        Write the stored stream if this exact render has been done before,
+        otherwise render it and store it.
+        If the terminal still holds all the images, only place them
+        """
+        key = STREAMS.key(self._files(), self._layout())
+        if self._replay(STREAMS.get(key)):
+            return
+
+        output = Output()
+        try:
+            self._render(output)
+        except IndexError:
+            output.emit(before=CLEAR)
+            return  # Incomplete, don't store
+        output.emit(before=CLEAR)
+        STREAMS.put(key, output.sizes, output.placements(), output.full())
+
+    @staticmethod
+    def _replay(stored):
+        if not stored:
+            return False
+        sizes, placements, full = stored
+
+        if REGISTRY.holds_all(sizes):
+            for image_id in sizes:
+                REGISTRY.use(image_id)
+            stream = placements
+        elif full:
+            evictions = [REGISTRY.add(image_id, size, keep=sizes)
+                         for (image_id, size) in sizes.items()]
+            stream = ''.join(evictions) + full
+        else:
+            return False
+
+        write(CLEAR + stream)
+        return True
+
+    @abstractmethod
+    def _render(self, output):
         raise NotImplementedError
 
 
@@ -109,6 +991,9 @@ class Gallery(View):
         Number of rows in each page
     print_rows : bool
         Whether to print row numbers in the bottom
+    atlas : str or None
+        'page' composites every page into one image before transmitting it,
+        'row' does it for every row; None transmits each image separately
 
     Info
     ========
@@ -117,19 +1002,132 @@ class Gallery(View):
     """
 
     def __init__(self, path, number_of_columns=5, rowspaces=(0, 9),
-                 page_spaces=(26, 24, 24), rows_in_page=2):
+                 page_spaces=(26, 24, 24), rows_in_page=2, atlas='page'):
         # Only to set default arguments here, no overriding
-        super().__init__(path, number_of_columns, rowspaces, page_spaces, rows_in_page)
+        super().__init__(path, number_of_columns, rowspaces, page_spaces,
+                         rows_in_page, atlas)
 
-    @funcy.ignore(IndexError)
-    def render(self):
-        os.system('clear')
+    def _render(self, output):
+        cell_px = self._cell_px()
         for (i, page) in enumerate(self._pages_list):
-            print('\n' * self._page_spaces[i])  # Scroll to new 'page'
-            display_page(page, self._rowspaces, self._cols, self._left_shifts,
-                         self._path)
+            output.write(line('\n' * self._page_spaces[i]))  # Scroll to new 'page'
+            self._display_page(output, page, cell_px)
+
+        output.write(COLUMN_LABELS)
+
+
+class Progressive:
+    """
+    A Gallery that is displayed while its images are still being downloaded,
+    each thumbnail as soon as it lands, instead of after all of them.
+
+    Cells are found from the number prefix of each file, and the images are
+    placed at absolute positions, so the order they arrive in doesn't matter;
+    pending cells show a placeholder until then. Pages still have to be shown
+    in order (printing page_spaces scrolls the previous page away), so images
+    for a later page are held back until every cell of the current page is
+    filled.
+
+    add() is called from the downloading threads (download.download_page's
+    on_done); render() runs in the main thread until every cell is filled or
+    the downloads have finished without filling them.
+    Nothing is stored in STREAMS: the next visit renders the page normally
+
+    Parameters
+    ========
+    number_of_images : int
+        Number of images that will be downloaded
+    The rest are the same as for Gallery
+    """
+    PLACEHOLDER = '[ loading ]'
+
+    def __init__(self, number_of_images, number_of_columns=5, rowspaces=(0, 9),
+                 page_spaces=(26, 24, 24), rows_in_page=2):
+        self._number_of_columns = number_of_columns
+        self._rowspaces = rowspaces
+        self._page_spaces = page_spaces
+        self._per_page = number_of_columns * rows_in_page
+
+        width = 90 // number_of_columns
+        calc = xcoord(number_of_columns=number_of_columns, width=width)
+        self._left_shifts = list(map(calc, range(number_of_columns)))
+
+        self._pages = [range(start, min(start + self._per_page, number_of_images))
+                       for start in range(0, number_of_images, self._per_page)]
+        assert len(self._pages) <= len(self._page_spaces)
+
+        self._queue = queue.Queue()
+        self._arrived = {}  # Number prefix: filepath
+        self._ids = {}  # Number prefix: image id
+        self._finished = threading.Event()
+
+    def add(self, filepath):
+        """
+        An image has finished downloading. None means that every download has
+        finished (or failed); that blocks until render() is done with the
+        files, as they're moved when the page is published
+        """
+        self._queue.put(filepath)
+        if filepath is None:
+            self._finished.wait()
 
-        print(' ' * 8, 1, ' ' * 15, 2, ' ' * 15, 3, ' ' * 15, 4, ' ' * 15, 5, '\n')
+    def cell(self, number):
+        """Position (x, y) of the image with the given number prefix"""
+        col = number % self._number_of_columns
+        row = number % self._per_page // self._number_of_columns
+        return self._left_shifts[col], self._rowspaces[row]
+
+    def render(self):
+        """Returns True if every image was displayed"""
+        try:
+            return self._render(Output())
+        finally:
+            self._finished.set()
+
+    def _render(self, output):
+        output.write(CLEAR)
+
+        for (i, page) in enumerate(self._pages):
+            output.write(line('\n' * self._page_spaces[i]))  # Scroll to new 'page'
+            for number in page:
+                if number not in self._arrived:
+                    output.write(place(*self.cell(number)) + self.PLACEHOLDER)
+
+            for number in page:
+                if number in self._arrived:
+                    self._display(output, number)
+            output.emit()
+
+            while not all(number in self._arrived for number in page):
+                if not self._wait(output, page):
+                    return False
+
+            # Place the last image again, to leave the cursor where a Gallery
+            # render would have left it
+            output.image(self._ids[page[-1]], *self.cell(page[-1]), None)
+            output.emit()
+
+        output.write(COLUMN_LABELS)
+        output.emit()
+        return True
+
+    def _wait(self, output, page):
+        """Display the next image to arrive, if it's in page"""
+        filepath = self._queue.get()
+        if filepath is None:
+            return False
+        number = number_prefix(os.path.basename(filepath))
+        self._arrived[number] = filepath
+        if number in page:
+            self._display(output, number)
+            output.emit()
+        return True
+
+    def _display(self, output, number, size=310):
+        myfile = self._arrived[number]
+        self._ids[number] = image_id(file_key(myfile), size)
+        output.image(self._ids[number], *self.cell(number),
+                     lambda: fit(PILImage.open(myfile), size))
 
 
 class Card(View):
@@ -149,43 +1147,134 @@ class Card(View):
     messages : list of str
         List of text to print next to the images. Only for when rows_in_page = 1
         len must be >= rows_in_page
+    atlas : bool
+        Whether to composite the profile pic and the three previews into one
+        strip per artist, so that they are transmitted as a single image
     """
 
     def __init__(self, path, preview_paths, messages,
                  preview_xcoords=[[40], [58], [75]], number_of_columns=1,
-                 rowspaces=(0,), page_spaces=(20,) * 30, rows_in_page=1):
+                 rowspaces=(0,), page_spaces=(20,) * 30, rows_in_page=1,
+                 atlas=True):
         # Set defaults ^^^
         self._preview_paths = preview_paths
         self._messages = messages
         self._preview_xcoords = preview_xcoords
-        self._preview_images: 'List[List[str]]'
         super().__init__(path, number_of_columns, rowspaces, page_spaces,
-                         rows_in_page)
+                         rows_in_page, atlas)
+        self._preview_images = list(
+            cytoolz.partition_all(3, sorted(os.listdir(self._preview_paths)))
+        )
 
-    @funcy.ignore(IndexError)
     def render(self):
         assert self._rows_in_page == 1
         assert len(self._messages) >= self._rows_in_page
+        super().render()
 
-        self._preview_images = list(
-            cytoolz.partition_all(3, sorted(os.listdir(self._preview_paths)))
-        )
+    def page_rows(self, image_rows):
+        return 1 + image_rows  # The message goes above
+
+    def draw_page(self, output, i, top):
+        output.write(place(19, top) + self._messages[i])
+        self._display_cells(output,
+                            shift_cells(self._strip_cells(self._pages_list[i], i),
+                                        top + 1),
+                            self._cell_px())
+
+    def _layout(self):
+        return (super()._layout(), self._messages, self._preview_xcoords)
 
-        os.system('clear')
+    def _files(self):
+        return super()._files() + [
+            os.path.join(self._preview_paths, myfile)
+            for previews in self._preview_images for myfile in previews
+        ]
+
+    def _render(self, output):
+        cell_px = self._cell_px()
         for (i, page) in enumerate(self._pages_list):
             # Print the message (artist name) first
-            print('\n' * 2)
-            print(' ' * 18, self._messages[i])
-            print('\n' * self._page_spaces[i])  # Scroll to new 'page'
-
-            # Display artist profile pic
-            display_page(page, self._rowspaces, self._cols, self._left_shifts,
-                         self._path)
-
-            # Display the three previews
-            for (j, coord) in enumerate(self._preview_xcoords):
-                display_page(((self._preview_images[i][j],),), self._rowspaces,
-                             self._cols, coord, self._preview_paths)
+            output.write(line('\n' * 2))
+            output.write(line(' ' * 18, self._messages[i]))
+            output.write(line('\n' * self._page_spaces[i]))  # Scroll to new 'page'
+
+            # Display artist profile pic and the three previews
+            # In atlas mode, they are composited into one strip
+            self._display_cells(output, self._strip_cells(page, i), cell_px)
+
+    def _strip_cells(self, page, i):
+        cells = page_cells(page, self._rowspaces, self._cols, self._left_shifts,
+                           self._path)
+        for (j, coord) in enumerate(self._preview_xcoords):
+            cells += page_cells(((self._preview_images[i][j],),), self._rowspaces,
+                                self._cols, coord, self._preview_paths)
+        return cells
+
+
+class Viewport:
+    """
+    Virtualized rendering of a View. Instead of printing every page and
+    letting the terminal scroll through all of them, only the pages that fit
+    on the screen are displayed, at absolute positions on a cleared screen.
+
+    Scrolling displays another window of pages and removes the placements of
+    the old ones. The terminal keeps their image data (up to REGISTRY's quota),
+    so scrolling back only places them again. The cost of a render is bounded
+    by the size of the screen, not by the number of pages.
+    Falls back to a normal render if the terminal size isn't known
+
+    Parameters
+    ========
+    view : View
+        What to display
+    margin_rows : int
+        Rows to leave free at the bottom, for the prompt
+    size : int
+        Size of the thumbnails, to work out how many rows they take up
+    """
+    def __init__(self, view, margin_rows=2, size=310):
+        self._view = view
+        self._margin_rows = margin_rows
+        self._size = size
+        self.top = 0  # First page on the screen
+
+    def visible(self, screen_rows, image_rows):
+        """The pages that fit on the screen, starting from the top one"""
+        pages, used = [], 0
+        for i in range(self.top, self._view.number_of_pages):
+            used += self._view.page_rows(image_rows)
+            if pages and used > screen_rows - self._margin_rows:
+                break
+            pages.append(i)
+        return pages
+
+    def render(self):
+        geometry, cell_px = terminal_geometry(), cell_size()
+        if not geometry or not cell_px:
+            self._view.render()
+            return
+
+        ((_, screen_rows), _) = geometry
+        image_rows = math.ceil(self._size / cell_px[1])
+
+        output = Output()
+        output.write(CLEAR)  # Deletes the placements, but keeps the images
+        row = 0
+        for i in self.visible(screen_rows, image_rows):
+            self._view.draw_page(output, i, row)
+            row += self._view.page_rows(image_rows)
+        output.write(place(0, row))
+        output.emit()
+
+    def scroll(self, pages):
+        """Move the window by a number of pages; False if it's already at the end"""
+        top = min(max(self.top + pages, 0), self._view.number_of_pages - 1)
+        if top == self.top:
+            return False
+        self.top = top
+        self.render()
+        return True
+
 
 if __name__ == '__main__':
     Gallery('/tmp/koneko/2232374/1/')
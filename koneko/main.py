@@ -15,18 +15,27 @@ import os
 import re
 import sys
 import time
+import atexit
+import threading
 from abc import ABC, abstractmethod
 from pathlib import Path
 
-from tqdm import tqdm
-
-from koneko import KONEKODIR, ui, api, cli, data, pure, utils, prompt, download
+from koneko import (KONEKODIR, ui, api, cli, data, pure, utils, prompt, download,
+                    cache, lscat, session)
 
 
 def main(start=True):
     """Read config file, start login, process any cli arguments, go to main loop"""
-    os.system('clear')
+    if start and (cache_args := cli.process_cache_args()):
+        utils.cache_command(cache_args)
+        sys.exit(0)
+
+    pure.clear_screen()
     credentials, your_id = utils.config()
+    utils.configure_lscat()
+    if start:
+        utils.configure_prefetch()
+        utils.start_background_jobs()
     if not Path('~/.local/share/koneko').expanduser().exists():
         print('Please wait, downloading welcome image (this will only occur once)...')
         baseurl = 'https://raw.githubusercontent.com/twenty5151/koneko/master/pics/'
@@ -36,11 +45,15 @@ def main(start=True):
         for pic in ('71471144_p0.png', '79494300_p0.png'):
             os.system(f'curl -s {baseurl}{pic} -o {basedir}{pic}')
 
-        os.system('clear')
+        pure.clear_screen()
 
     api.myapi.add_credentials(credentials)
     if start:
         api.myapi.start()
+        atexit.register(session.save)
+        if cli.process_resume_arg() and (saved := session.load()):
+            resume(saved)
+            main(start=False)
 
     # After this part, the API is logging in in the background and we can proceed
     prompted, main_command, user_input = cli.process_cli_args()
@@ -113,6 +126,25 @@ def main_loop(prompted, main_command, user_input, your_id=None, start=True):
             continue
 
 
+def resume(saved):
+    """
+    Go back to the view in a session.Saved, shown from the cache. Logging in
+    carries on in the background, until the first request needs it
+    """
+    state = saved.state
+    if saved.mode == '1':
+        ArtistGalleryMode(state['artist_user_id'], state['page_num'], saved=saved)
+    elif saved.mode == '5':
+        IllustFollowMode(state['page_num'], saved=saved)
+    elif saved.mode == '2':
+        view_post_mode(state['image_id'], state['post'])
+    elif saved.mode in ('3', '4'):
+        users = ui.FollowingUsers if saved.mode == '3' else ui.SearchUsers
+        mode = users(state['input'])
+        mode.resume(saved)
+        prompt.user_prompt(mode)
+
+
 #- Loop classes
 class Loop(ABC):
     """Ask for details relevant to mode then go to mode
@@ -136,7 +168,7 @@ class Loop(ABC):
                 self._prompt_url_id()
                 self._process_url_or_input()
                 self._validate_input()
-                os.system('clear')
+                pure.clear_screen()
 
             if start:
                 api.myapi.await_login()
@@ -259,9 +291,11 @@ class IllustFollowModeLoop:
 
 # - Mode classes
 class GalleryLikeMode(ABC):
-    def __init__(self, current_page_num=1, gdata=None):
+    def __init__(self, current_page_num=1, gdata=None, saved=None):
+        """saved: a session.Saved to restore the data and image view from"""
         self._current_page_num = current_page_num
         self.data = gdata
+        self._saved = saved
         self._show = True
         # Defined in child classes
         self._download_path: str
@@ -286,9 +320,14 @@ class GalleryLikeMode(ABC):
         else:
             self._show = True
 
-        if not self.data:
+        if not self.data and self._saved:
+            self.data = data.GalleryJson.restore(self._saved,
+                                                 fetch=self._pixivrequest_next,
+                                                 max_pages=utils.pages_in_memory())
+        elif not self.data:
             current_page = self._pixivrequest()
-            self.data = data.GalleryJson(current_page)
+            self.data = data.GalleryJson(current_page, fetch=self._pixivrequest_next,
+                                         max_pages=utils.pages_in_memory())
         self._init_download()
         if self._show:
             utils.show_artist_illusts(self._download_path)
@@ -298,23 +337,61 @@ class GalleryLikeMode(ABC):
     def _pixivrequest(self):
         raise NotImplementedError
 
-    def _download_pbar(self):
-        pbar = tqdm(total=len(self.data.current_illusts()), smoothing=0)
-        download.download_page(self.data.current_illusts(), self._download_path,
-                               pbar=pbar)
-        pbar.close()
+    @abstractmethod
+    def _pixivrequest_next(self, next_url):
+        """Request the page at next_url (for pages that have been evicted)"""
+        raise NotImplementedError
+
+    def _download_progressive(self):
+        """
+        Download in the background while the gallery is displayed, each
+        thumbnail as soon as it lands. Only needs to be shown again if
+        the downloads were done by another instance. If a download fails,
+        the page is left as it was (shown, if there is one) and the error
+        reported, to be tried again eg with reload
+        """
+        illusts = self.data.current_illusts(self._current_page_num)
+        gallery = lscat.Progressive(len(illusts))
+        errors = []
+
+        def download_page():
+            try:
+                download.download_page(illusts, self._download_path,
+                                       on_done=gallery.add)
+            except Exception as err:  # Reported once the gallery is done
+                errors.append(err)
+            finally:
+                gallery.add(None)
+
+        downloader = threading.Thread(target=download_page)
+        downloader.start()
+        complete = gallery.render()
+        downloader.join()
+        if errors:
+            if Path(self._download_path).is_dir():
+                utils.show_artist_illusts(self._download_path)
+            print(f'Page {self._current_page_num} failed to download '
+                  f'({errors[0]!r}), try again')
+            self._show = False
+        else:
+            self._show = not complete
 
     def _init_download(self):
         if not Path(self._download_path).is_dir():
-            self._download_pbar()
-
-        elif (not self.data.titles[0] in sorted(os.listdir(self._download_path))[0]
-              and self._current_page_num == 1):
-            print('Cache is outdated, reloading...')
-            # Remove old images
-            os.system(f'rm -r {self._download_path}') # shutil.rmtree is better
-            self._download_pbar()
-            self._show = True
+            self._download_progressive()
+
+        elif self._outdated():
+            print('Cache is outdated, updating...')
+            self._download_progressive()
+
+    def _outdated(self):
+        """Whether the page directory doesn't hold the current page"""
+        if manifest := cache.read_manifest(self._download_path):
+            return manifest != pure.page_manifest(
+                self.data.current_illusts(self._current_page_num))
+        # Downloaded before manifests: only the first page is checked
+        return (not self.data.titles[0] in sorted(os.listdir(self._download_path))[0]
+                and self._current_page_num == 1)
 
 
     @abstractmethod
@@ -322,52 +399,68 @@ class GalleryLikeMode(ABC):
         """Instantiate the correct Gallery class"""
         raise NotImplementedError
 
+    def _prompt(self):
+        """The gallery prompt, or the image that was being viewed (resumed)"""
+        image_num = self._saved.state['image_num'] if self._saved else None
+        if image_num is None:
+            prompt.gallery_like_prompt(self.gallery)
+        else:
+            self.gallery.view_image(image_num)
+
 class ArtistGalleryMode(GalleryLikeMode):
-    def __init__(self, artist_user_id, current_page_num=1, gdata=None):
+    def __init__(self, artist_user_id, current_page_num=1, gdata=None, saved=None):
         self._artist_user_id = artist_user_id
         self._download_path = f'{KONEKODIR}/{artist_user_id}/{current_page_num}/'
-        super().__init__(current_page_num, gdata)
+        super().__init__(current_page_num, gdata, saved)
 
     def _pixivrequest(self):
         return api.myapi.artist_gallery_request(self._artist_user_id)
 
+    def _pixivrequest_next(self, next_url):
+        return api.myapi.artist_gallery_parse_next(**api.myapi.parse_next(next_url))
+
     def _instantiate(self):
         self.gallery = ui.ArtistGallery(
             self.data,
             self._current_page_num,
             self._artist_user_id,
         )
-        prompt.gallery_like_prompt(self.gallery)
+        self._prompt()
         # After backing, exit mode. The class that instantiated this mode
         # should catch the back.
 
 
 class IllustFollowMode(GalleryLikeMode):
-    def __init__(self, current_page_num=1, gdata=None):
+    def __init__(self, current_page_num=1, gdata=None, saved=None):
         self._download_path = f'{KONEKODIR}/illustfollow/{current_page_num}/'
-        super().__init__(current_page_num, gdata)
+        super().__init__(current_page_num, gdata, saved)
 
     def _pixivrequest(self):
         return api.myapi.illust_follow_request(restrict='private') # Publicity
 
+    def _pixivrequest_next(self, next_url):
+        return api.myapi.illust_follow_request(**api.myapi.parse_next(next_url))
+
     def _instantiate(self):
         self.gallery = ui.IllustFollowGallery(self.data, self._current_page_num)
-        prompt.gallery_like_prompt(self.gallery)
+        self._prompt()
         # After backing
         main(start=False)
 
-def view_post_mode(image_id):
+def view_post_mode(image_id, post_json=None):
     """
     Fetch all the illust info, download it in the correct directory, then display it.
     If it is a multi-image post, download the next image
     Else or otherwise, open image prompt
+    post_json is only given when resuming, to skip fetching it
     """
-    print('Fetching illust details...')
-    try:
-        post_json = api.myapi.protected_illust_detail(image_id)['illust']
-    except KeyError:
-        print('Work has been deleted or the ID does not exist!')
-        sys.exit(1)
+    if not post_json:
+        print('Fetching illust details...')
+        try:
+            post_json = api.myapi.protected_illust_detail(image_id)['illust']
+        except KeyError:
+            print('Work has been deleted or the ID does not exist!')
+            sys.exit(1)
 
     idata = data.ImageJson(post_json, image_id)
 
@@ -380,6 +473,8 @@ def view_post_mode(image_id):
         downloaded_images = list(map(pure.split_backslash_last, idata.page_urls[:2]))
 
     image = ui.Image(image_id, idata, 1, True)
+    session.track(image)
+    session.checkpoint()
     prompt.image_prompt(image)
 
 if __name__ == '__main__':
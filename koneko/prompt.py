@@ -117,6 +117,9 @@ def gallery_like_prompt(gallery_like_class):
             elif gallery_command == 'r':
                 break
 
+            elif gallery_command == 'f':
+                break  # input() needs the terminal out of cbreak
+
             elif gallery_command == 'm':
                 print(gallery_like_class.__doc__)
 
@@ -147,6 +150,16 @@ def image_prompt(image):
         'd': image.download_image,
         'n': image.next_image,
         'p': image.previous_image,
+        '+': lambda: image.zoom(1),
+        '=': lambda: image.zoom(1),
+        '-': lambda: image.zoom(-1),
+    }
+    # Arrow keys: (right, down)
+    pan = {
+        TERM.KEY_LEFT: (-1, 0),
+        TERM.KEY_RIGHT: (1, 0),
+        TERM.KEY_UP: (0, -1),
+        TERM.KEY_DOWN: (0, 1),
     }
 
     with TERM.cbreak():
@@ -159,6 +172,9 @@ def image_prompt(image):
             if func:
                 func()
 
+            elif image_prompt_command.code in pan:
+                image.pan(*pan[image_prompt_command.code])
+
             elif image_prompt_command == 'm':
                 print(image.__doc__)
 
@@ -169,6 +185,7 @@ def image_prompt(image):
                     colors.p, 'revious image; ',
                     colors.d_, 'ownload image;',
                     colors.o_, 'pen image in browser;\n',
+                    'zoom in (+) and out (-), move with the arrow keys; ',
                     colors.q, 'uit (with confirmation); ',
                     'view ', colors.m, 'anual\n'
                 ]))
@@ -218,9 +235,18 @@ def user_prompt(user_class):
             elif user_prompt_command == 'p':
                 user_class.previous_page()
 
+            elif user_prompt_command == 'j':
+                user_class.scroll(1)
+
+            elif user_prompt_command == 'k':
+                user_class.scroll(-1)
+
             elif user_prompt_command == 'r':
                 break
 
+            elif user_prompt_command == 'g':
+                break  # input() needs the terminal out of cbreak
+
             # Wait for the rest of the sequence
             elif user_prompt_command in sequenceable_keys:
                 keyseqs.append(user_prompt_command)
@@ -256,6 +282,8 @@ def user_prompt(user_class):
                     colors.i, "view nth artist's illusts",
                     colors.n, 'ext page; ',
                     colors.p, 'revious page; ',
+                    colors.g, 'o to a page; ',
+                    'scroll down (j) and up (k); ',
                     colors.r, 'eload and re-download all; ',
                     colors.q, 'uit (with confirmation);\n',
                     'view ', colors.m, 'anual\n'
@@ -273,5 +301,7 @@ def user_prompt(user_class):
 
     if user_prompt_command == 'r':
         user_class.reload()
+    elif user_prompt_command == 'g':
+        user_class.go_to_page()
     else:
         user_class.go_artist_mode(selected_user_num)
@@ -13,6 +13,17 @@ import funcy
 import cytoolz
 from colorama import Fore
 
+# Clears the screen, but not kitty's image data (lscat.REGISTRY): delete the
+# placements on the screen (lowercase d keeps their images), then home and
+# erase below. Erasing the whole screen or the scrollback (ED 2 or 3, as the
+# clear command does) would make kitty free every image without a placement
+CLEAR = '\x1b_Ga=d,d=a,q=2;\x1b\\\x1b[H\x1b[J'
+
+
+def clear_screen():
+    """Clear the screen, without starting a process (see CLEAR)"""
+    print(CLEAR, end='', flush=True)
+
 
 @contextmanager
 def cd(newdir):
@@ -45,14 +56,19 @@ def spin(done, message):
 def spinner(call, message=''):
     """
     See http://hackflow.com/blog/2013/11/03/painless-decorators/
+    Only shown on the main thread: work in the background (ui.Prefetch)
+    mustn't draw over the prompt
     """
+    if threading.current_thread() is not threading.main_thread():
+        return call()
     done = threading.Event()
     spinner_thread = threading.Thread(target=spin, args=(done, message))
     spinner_thread.start()
-    result = call()
-    done.set()
-    spinner_thread.join()
-    return result
+    try:
+        return call()
+    finally:
+        done.set()
+        spinner_thread.join()
 
 
 def split_backslash_last(string):
@@ -103,6 +119,37 @@ def print_multiple_imgs(illusts_json):
     print('')
 
 
+def parse_filter(text):
+    """
+    Parse a gallery filter, eg 'multi tag:landscape bookmarks:1000 sort:pages'
+    into keyword arguments for data.IllustTable.select(), and the sort key.
+    Terms:
+        multi           only multi-page posts
+        tag:{name}      only posts with a tag containing name (repeatable)
+        bookmarks:{n}   only posts with at least n bookmarks
+        user:{id}       only posts by that artist
+        sort:{key}      sort by bookmarks (default), pages or id
+    Raises ValueError for anything else
+    """
+    conditions = {'tags': []}
+    sort = 'bookmarks'
+    for term in text.split():
+        key, _, value = term.partition(':')
+        if term == 'multi':
+            conditions['multi_page'] = True
+        elif key == 'tag' and value:
+            conditions['tags'].append(value)
+        elif key == 'bookmarks' and value.isdigit():
+            conditions['min_bookmarks'] = int(value)
+        elif key == 'user' and value.isdigit():
+            conditions['user_id'] = int(value)
+        elif key == 'sort' and value in ('bookmarks', 'pages', 'id'):
+            sort = value
+        else:
+            raise ValueError(f'Invalid filter: {term}')
+    return conditions, sort
+
+
 @cytoolz.curry
 def url_given_size(post_json, size):
     """
@@ -129,6 +176,24 @@ def post_titles_in_page(current_page_illusts):
     return titles
 
 
+def manifest_entry(id_, url, name, number, folder=''):
+    """
+    An entry of a page directory's manifest (cache.read_manifest), for a url
+    downloaded and renamed like download.async_download_core does
+    """
+    filename = prefix_filename(split_backslash_last(url), name, number)
+    return {'id': id_, 'url': url, 'file': folder + filename.replace('/', '')}
+
+
+def page_manifest(current_page_illusts):
+    """What a gallery page's directory holds (for cache.refreshing)"""
+    urls = medium_urls(current_page_illusts)
+    titles = post_titles_in_page(current_page_illusts)
+    return [manifest_entry(illust['id'], url, title, number)
+            for (number, (illust, url, title))
+            in enumerate(zip(current_page_illusts, urls, titles))]
+
+
 @spinner('')
 def page_urls_in_post(post_json, size='medium'):
     """Get the number of pages and each of their urls in a multi-image post."""
@@ -167,7 +232,7 @@ def catch_ctrl_c(call):
     try:
         result = call()
     except KeyboardInterrupt:
-        os.system('clear')
+        clear_screen()
     else:
         return result
 
@@ -0,0 +1,98 @@
+"""
+Session snapshots, so that `koneko --resume` can show the view that was open
+when koneko last exited straight from the cache, before logging in.
+
+The view being browsed registers itself with track(); its snapshot() returns
+(mode, state, sections). It's saved to KONEKODIR/.session on exit, and at
+most every INTERVAL seconds while browsing (checkpoint()), as:
+    MAGIC, the length of the header (4 bytes), the header, the sections
+The header (a pickle of the mode, state, and where each section is) is read
+at once; each section (eg a page of posts) is a pickle of its own, read only
+when it's used.
+"""
+
+import os
+import time
+import pickle
+import struct
+
+from koneko import KONEKODIR
+
+SESSION_PATH = KONEKODIR / '.session'
+MAGIC = b'koneko-session\x01'
+LENGTH = struct.Struct('>I')
+INTERVAL = 30
+
+_view = None
+_last_save = 0
+
+
+def track(view):
+    """The view to save from now on"""
+    global _view
+    _view = view
+
+
+def save(path=SESSION_PATH):
+    """Write a snapshot of the tracked view, replacing the previous one"""
+    global _last_save
+    if not _view:
+        return
+    mode, state, sections = _view.snapshot()
+    blobs = [pickle.dumps(section, pickle.HIGHEST_PROTOCOL)
+             for section in sections.values()]
+    index, offset = {}, 0
+    for (name, blob) in zip(sections, blobs):
+        index[name] = (offset, len(blob))
+        offset += len(blob)
+    header = pickle.dumps({'mode': mode, 'state': state, 'index': index},
+                          pickle.HIGHEST_PROTOCOL)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp = path.with_name(f'{path.name}.{os.getpid()}')
+    with open(temp, 'wb') as f:
+        f.write(MAGIC + LENGTH.pack(len(header)) + header)
+        f.writelines(blobs)
+    os.replace(temp, path)
+    _last_save = time.monotonic()
+
+
+def checkpoint():
+    """Save, unless the last save was less than INTERVAL seconds ago"""
+    if time.monotonic() - _last_save >= INTERVAL:
+        save()
+
+
+class Saved:
+    """
+    A snapshot read back: mode and state are read at once, sections only by
+    section(name). The file stays open, so a new snapshot replacing it
+    doesn't change what's read
+    """
+    def __init__(self, path=SESSION_PATH):
+        self._file = open(path, 'rb')
+        if self._file.read(len(MAGIC)) != MAGIC:
+            self._file.close()
+            raise ValueError(f'{path} is not a koneko session')
+        (length,) = LENGTH.unpack(self._file.read(LENGTH.size))
+        header = pickle.loads(self._file.read(length))
+        self._start = len(MAGIC) + LENGTH.size + length
+        self.mode = header['mode']
+        self.state = header['state']
+        self._index = header['index']
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def section(self, name):
+        offset, length = self._index[name]
+        self._file.seek(self._start + offset)
+        return pickle.loads(self._file.read(length))
+
+
+def load(path=SESSION_PATH):
+    """The saved session, or None if there isn't a readable one"""
+    try:
+        return Saved(path)
+    except (OSError, ValueError, EOFError, struct.error, pickle.UnpicklingError):
+        return None
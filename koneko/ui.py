@@ -1,36 +1,209 @@
 """Handles user interaction inside all the modes. No knowledge of API needed"""
 
 import os
+import threading
 from abc import ABC, abstractmethod
+from concurrent import futures
+from glob import glob
 from pathlib import Path
 
 import funcy
 from tqdm import tqdm
 
 from koneko import (KONEKODIR, api, data, main, pure, lscat, utils, colors,
-                    prompt, download)
+                    prompt, download, cache, session)
 
 
 class LastPageException(ValueError):
     pass
 
+
+class Prefetch:
+    """
+    Fetches and downloads a page in a background thread, so that the prompt
+    doesn't wait for it. fetch(progress) returns the page's json (or None if
+    there's no such page). It calls progress.fetched(json) as soon as it has
+    it, then progress.expect(number of images) and progress.add(filepath) as
+    they land.
+    Progress isn't shown while in the background (it would write over the
+    prompt); wait() shows a progress bar for whatever is left.
+    POOL's workers are the most pages downloaded at once; pages are started
+    in the order they were asked for, so the nearest first
+    """
+    POOL = futures.ThreadPoolExecutor(max_workers=2)
+
+    def __init__(self, fetch):
+        self.done = 0
+        self.total = 0
+        self.bytes = 0
+        self._lock = threading.Lock()  # add() is called from download threads
+        self._page = futures.Future()
+        self._future = self.POOL.submit(self._run, fetch)
+
+    def _run(self, fetch):
+        try:
+            return fetch(self)
+        except BaseException as err:
+            if not self._page.done():
+                self._page.set_exception(err)
+            raise
+        finally:
+            if not self._page.done():
+                self._page.set_result(None)
+
+    def fetched(self, page):
+        self._page.set_result(page)
+
+    def expect(self, total):
+        self.total = total
+
+    def add(self, filepath):
+        """download's on_done"""
+        if filepath:
+            size = os.path.getsize(filepath)
+            with self._lock:
+                self.done += 1
+                self.bytes += size
+
+    def finished(self):
+        return self._future.done()
+
+    def cancel(self):
+        """Cancel it if it hasn't started yet; returns whether it was cancelled"""
+        if self._future.cancel():
+            self._page.cancel()
+            return True
+        return False
+
+    def page(self):
+        """The page's json, without waiting for its images"""
+        return self._page.result()
+
+    def wait(self):
+        """The page's json, once it's fetched and downloaded. Re-raises errors"""
+        with funcy.suppress(Exception):  # Raised again by result()
+            self.page()  # The number of images is only known after the json
+        if not self._future.done() and self.total:
+            with tqdm(total=self.total, initial=self.done, smoothing=0) as pbar:
+                while not futures.wait([self._future], timeout=0.1).done:
+                    pbar.total = self.total
+                    pbar.update(self.done - pbar.n)
+        return self._future.result()
+
+
+# Download path: Prefetch, until its page is added to a view's data
+PREFETCHES = {}
+
+# From the [Prefetch] section of the config file (utils.configure_prefetch):
+# how many pages to prefetch ahead, and how many bytes they can take at most
+LOOKAHEAD_PAGES = 1
+LOOKAHEAD_BYTES = 64 * 2**20
+
+
+def dir_bytes(path):
+    """Total size of the files in a directory and its subdirectories"""
+    return sum(os.path.getsize(os.path.join(root, name))
+               for (root, _, files) in os.walk(path) for name in files)
+
+
+def focus_prefetches(prefix):
+    """
+    Cancel the prefetches (that haven't started yet) of every view except
+    the one whose pages are under prefix, so they don't hold up its pages
+    """
+    for (path, prefetch) in list(PREFETCHES.items()):
+        if not path.startswith(prefix) and prefetch.cancel():
+            del PREFETCHES[path]
+
+
+def drop_prefetches(prefix):
+    """
+    Forget the prefetches of the view whose pages are under prefix, eg before
+    deleting its pages. Ones that have started are waited for, otherwise they
+    could publish a page after it's been deleted
+    """
+    for path in [path for path in PREFETCHES if path.startswith(prefix)]:
+        prefetch = PREFETCHES.pop(path)
+        if not prefetch.cancel():
+            with funcy.suppress(Exception):
+                prefetch.wait()
+
+
+def within_budget(prefix, estimate):
+    """
+    Whether another page of about estimate bytes can be prefetched for the
+    view whose pages are under prefix. The nearest page always can
+    """
+    ahead = [prefetch for (path, prefetch) in PREFETCHES.items()
+             if path.startswith(prefix)]
+    used = sum(prefetch.bytes if prefetch.finished()
+               else max(prefetch.bytes, estimate) for prefetch in ahead)
+    return not ahead or used + estimate <= LOOKAHEAD_BYTES
+
+
+def forget_prefetches(prefix):
+    """
+    Cancel the prefetches of the view whose pages are under prefix that
+    haven't started, and stop waiting for the others, eg after jumping away
+    from them. Those still finish downloading into the cache
+    """
+    for path in [path for path in PREFETCHES if path.startswith(prefix)]:
+        PREFETCHES.pop(path).cancel()
+
+
+# The most user list pages requested at once by fan_out ([Prefetch] fan_out)
+FAN_OUT = 8
+REQUESTS = futures.ThreadPoolExecutor(max_workers=FAN_OUT)
+
+
+def fan_out(request, page_nums):
+    """
+    Request consecutive pages of a user list by their offsets, FAN_OUT at a
+    time, so that each batch takes about one round trip. request(offset)
+    returns a page's json.
+    Returns {page number: json} up to the last page, or up to and including
+    the first empty page; batches after it aren't requested. An error reply
+    (eg to an offset that's too large) has no user_previews, so it counts as
+    an empty page
+    """
+    page_nums = list(page_nums)
+    pages = {}
+    for start in range(0, len(page_nums), FAN_OUT):
+        batch = page_nums[start:start + FAN_OUT]
+        results = REQUESTS.map(lambda page_num: request((page_num - 1) * 30), batch)
+        for (page_num, page) in zip(batch, results):
+            pages[page_num] = page
+            if not page.get('user_previews') or not page.get('next_url'):
+                return pages
+    return pages
+
+
 class AbstractGallery(ABC):
     def __init__(self, gdata, current_page_num):
         self._current_page_num = current_page_num
         self.data = gdata
         # Defined in self.view_image
         self._selected_image_num: int
+        self._viewing = None  # The image number, while in image view
         # Defined in child classes
         self._main_path: str
+        self._mode: str
 
         pure.print_multiple_imgs(self.data.current_page_illusts)
         print(f'Page {self._current_page_num}')
         # Make sure the following work:
         # Gallery -> next page -> image prompt -> back -> prev page
-        if len(self.data.all_pages_cache) == 1:
-            # Prefetch the next page on first gallery load
-            with funcy.suppress(LastPageException):
-                self._prefetch_next_page()
+        # Also tops up the lookahead when coming back to this gallery
+        with funcy.suppress(LastPageException):
+            self._top_up()
+        session.track(self)
+        session.checkpoint()
+
+    def snapshot(self):
+        """(mode, state, sections) to save the session with"""
+        state, sections = self.data.snapshot()
+        state.update(page_num=self._current_page_num, image_num=self._viewing)
+        return self._mode, state, sections
 
     def open_link_coords(self, first_num, second_num):
         selected_image_num = pure.find_number_map(int(first_num), int(second_num))
@@ -64,7 +237,7 @@ class AbstractGallery(ABC):
         image_id = post_json.id
         idata = data.ImageJson(post_json, image_id)
 
-        display_image(
+        displayed = display_image(
             post_json,
             idata.artist_user_id,
             self._selected_image_num,
@@ -72,8 +245,11 @@ class AbstractGallery(ABC):
         )
 
         # blocking: no way to unblock prompt
-        image = Image(image_id, idata, self._current_page_num, False)
+        image = Image(image_id, idata, self._current_page_num, False, displayed)
+        self._viewing = selected_image_num
+        session.checkpoint()
         prompt.image_prompt(image)
+        self._viewing = None
 
         # Image prompt ends, user presses back
         self._back()
@@ -83,6 +259,11 @@ class AbstractGallery(ABC):
         raise NotImplementedError
 
     def next_page(self):
+        # Only waits for what's left of the prefetch, if it hasn't finished
+        with funcy.suppress(LastPageException):
+            self._top_up()  # In case it was cancelled
+        if not self._finish_prefetch(self._current_page_num + 1):
+            return
         download_path = f'{self._main_path}/{self._current_page_num+1}/'
         try:
             utils.show_artist_illusts(download_path)
@@ -92,14 +273,13 @@ class AbstractGallery(ABC):
             self._current_page_num += 1
             print(f'Page {self._current_page_num}')
             print('Enter a gallery command:\n')
+            session.checkpoint()
 
-        # Skip prefetching again for cases like next -> prev -> next
-        if str(self._current_page_num + 1) not in self.data.cached_pages():
-            try:
-                # After showing gallery, pre-fetch the next page
-                self._prefetch_next_page()
-            except LastPageException:
-                print('This is the last page!')
+        try:
+            # After showing gallery, keep prefetching ahead
+            self._top_up()
+        except LastPageException:
+            print('This is the last page!')
 
     def previous_page(self):
         if self._current_page_num > 1:
@@ -112,6 +292,7 @@ class AbstractGallery(ABC):
             utils.show_artist_illusts(download_path)
             print(f'Page {self._current_page_num}')
             print('Enter a gallery command:\n')
+            session.checkpoint()
 
         else:
             print('This is the first page!')
@@ -120,36 +301,105 @@ class AbstractGallery(ABC):
     def _pixivrequest(self, **kwargs):
         raise NotImplementedError
 
-    def _prefetch_next_page(self):
-        # TODO: move this somewhere else
-        # print("   Prefetching next page...", flush=True, end="\r")
-        next_url = self.data.next_url(self._current_page_num)
-        if not next_url:  # this is the last page
-            raise LastPageException
-
-        parse_page = api.myapi.parse_next(next_url)
-        next_page = self._pixivrequest(**parse_page)
-        self.data.all_pages_cache[str(self._current_page_num + 1)] = next_page
-        current_page_illusts = next_page['illusts']
-
-        download_path = f'{self._main_path}/{self._current_page_num+1}/'
-        if not Path(download_path).is_dir():
-            pbar = tqdm(total=len(current_page_illusts), smoothing=0)
-            download.download_page(
-                current_page_illusts, download_path, pbar=pbar
-            )
-            pbar.close()
+    def _top_up(self):
+        """
+        Keep the LOOKAHEAD_PAGES pages after the current one fetched and
+        downloaded in the background, nearest first, as far as LOOKAHEAD_BYTES
+        allows (estimating from the current page). Raises LastPageException
+        if the current page is the last one.
+        The json of a page is only added to self.data by _finish_prefetch (in
+        this thread), so self.data is never used by two threads at once
+        """
+        focus_prefetches(self._main_path)
+        estimate = dir_bytes(f'{self._main_path}/{self._current_page_num}/')
+        previous = None  # The prefetch of the page before, if it's still pending
+        for page_num in range(self._current_page_num + 1,
+                              self._current_page_num + LOOKAHEAD_PAGES + 1):
+            download_path = f'{self._main_path}/{page_num}/'
+            if download_path in PREFETCHES or str(page_num) in self.data.cached_pages():
+                previous = PREFETCHES.get(download_path)
+                continue
+            if not within_budget(self._main_path, estimate):
+                return
+            next_url = None
+            if not previous:
+                next_url = self.data.next_url(page_num - 1)
+                if not next_url:  # page_num - 1 is the last page
+                    if page_num == self._current_page_num + 1:
+                        raise LastPageException
+                    return
+            previous = PREFETCHES[download_path] = Prefetch(
+                self._fetch_page(download_path, previous, next_url))
+
+    def _fetch_page(self, download_path, previous, next_url):
+        """The job of a Prefetch. next_url is previous's, if there is one"""
+        def fetch(progress):
+            url = next_url
+            if previous:
+                url = (page := previous.page()) and page['next_url']
+            if not url:
+                return None  # Past the last page
+            page = self._pixivrequest(**api.myapi.parse_next(url))
+            progress.fetched(page)
+            manifest = cache.read_manifest(download_path)
+            if (not Path(download_path).is_dir()
+                    or manifest and manifest != pure.page_manifest(page['illusts'])):
+                progress.expect(len(page['illusts']))
+                download.download_page(page['illusts'], download_path,
+                                       on_done=progress.add)
+            return page
+        return fetch
+
+    def _finish_prefetch(self, page_num):
+        """Add a prefetched page to self.data; returns whether it didn't fail"""
+        prefetch = PREFETCHES.pop(f'{self._main_path}/{page_num}/', None)
+        try:
+            page = prefetch and prefetch.wait()
+        except futures.CancelledError:
+            # It needed the page before's prefetch, which was cancelled (eg by
+            # focus_prefetches); nothing failed, so prefetch them again
+            forget_prefetches(f'{self._main_path}/')
+            with funcy.suppress(LastPageException):
+                self._top_up()
+            return self._finish_prefetch(page_num)
+        except Exception as err:  # Prefetched again by the next _top_up
+            print(f'Page {page_num} failed to download ({err!r}), try again')
+            return False
+        if page:
+            self.data.add_page(page_num, page)
+        return True
 
     def reload(self):
         ans = input('This will delete cached images and redownload them. Proceed?\n')
         if ans == 'y' or not ans:
-            os.system(f'rm -r {self._main_path}') # shutil.rmtree is better
-            self.data.all_pages_cache = {} # Ensures prefetch after reloading
+            drop_prefetches(self._main_path)
+            cache.remove_all(self._main_path)
+            self.data.all_pages_cache.clear() # Ensures prefetch after reloading
             self._back()
         else:
             # After reloading, back will return to the same mode again
             prompt.gallery_like_prompt(self)
 
+    def filter(self):
+        """
+        List the illusts on every page fetched so far that match a filter,
+        without any requests
+        """
+        print('multi  tag:{name}  bookmarks:{n}  user:{id}  sort:{bookmarks|pages|id}')
+        try:
+            conditions, sort = pure.parse_filter(input('Filter: '))
+        except ValueError as err:
+            print(err)
+            return
+
+        table = self.data.table
+        rows = table.sort(table.select(**conditions), sort)
+        for row in rows:
+            print(f'Page {table.pages[row]} #{table.positions[row]:02} '
+                  f'{table.titles[row]} ({table.page_counts[row]} pages, '
+                  f'{table.bookmarks[row]} bookmarks)')
+        print(f'{len(rows)} of {len(table)} illusts\n')
+
     @abstractmethod
     def handle_prompt(self, keyseqs, gallery_command, selected_image_num,
                       first_num, second_num):
@@ -176,6 +426,7 @@ class ArtistGallery(AbstractGallery):
 
         n                  -- view the next page
         p                  -- view the previous page
+        f                  -- filter the illusts on the pages seen so far
         r                  -- delete all cached images, re-download and reload view
         b                  -- go back to previous mode (either 3, 4, 5, or main screen)
         h                  -- show keybindings
@@ -195,10 +446,16 @@ class ArtistGallery(AbstractGallery):
     """
     def __init__(self, gdata, current_page_num, artist_user_id, **kwargs):
         self._main_path = f'{KONEKODIR}/{artist_user_id}/'
+        self._mode = '1'
         self._artist_user_id = artist_user_id
         self._kwargs = kwargs
         super().__init__(gdata, current_page_num)
 
+    def snapshot(self):
+        mode, state, sections = super().snapshot()
+        state['artist_user_id'] = self._artist_user_id
+        return mode, state, sections
+
     def _pixivrequest(self, **kwargs):
         return api.myapi.artist_gallery_parse_next(**kwargs)
 
@@ -214,6 +471,9 @@ class ArtistGallery(AbstractGallery):
             pass # Stop gallery instance, return to previous state
         elif gallery_command == 'r':
             self.reload()
+        elif gallery_command == 'f':
+            self.filter()
+            prompt.gallery_like_prompt(self) # Go back to while loop
         elif keyseqs[0] == 'i':
             self.view_image(selected_image_num)
         elif keyseqs[0].lower() == 'a':
@@ -252,6 +512,7 @@ class IllustFollowGallery(AbstractGallery):
 
         n                  -- view the next page
         p                  -- view the previous page
+        f                  -- filter the illusts on the pages seen so far
         r                  -- delete all cached images, re-download and reload view
         b                  -- go back to main screen
         h                  -- show keybindings
@@ -271,6 +532,7 @@ class IllustFollowGallery(AbstractGallery):
     """
     def __init__(self, gdata, current_page_num):
         self._main_path = f'{KONEKODIR}/illustfollow/'
+        self._mode = '5'
         super().__init__(gdata, current_page_num)
 
     def _pixivrequest(self, **kwargs):
@@ -305,6 +567,9 @@ class IllustFollowGallery(AbstractGallery):
             prompt.gallery_like_prompt(self) # Go back to while loop
         elif gallery_command == 'r':
             self.reload()
+        elif gallery_command == 'f':
+            self.filter()
+            prompt.gallery_like_prompt(self) # Go back to while loop
         elif keyseqs[0] == 'i':
             self.view_image(selected_image_num)
         elif keyseqs[0] == 'a':
@@ -325,6 +590,7 @@ class IllustFollowGallery(AbstractGallery):
             colors.a, "view artist's illusts; ",
             colors.n, 'ext page;\n',
             colors.p, 'revious page; ',
+            colors.f, 'ilter the illusts seen so far; ',
             colors.r, 'eload and re-download all; ',
             colors.q, 'uit (with confirmation); ',
             'view ', colors.m, 'anual\n']))
@@ -332,7 +598,7 @@ class IllustFollowGallery(AbstractGallery):
 def display_image(post_json, artist_user_id, number_prefix, current_page_num):
     """
     Opens image given by the number (medium-res), downloads large-res and
-    then display that.
+    then display that. Returns the path of the large-res image
 
     Parameters
     ----------
@@ -345,9 +611,9 @@ def display_image(post_json, artist_user_id, number_prefix, current_page_num):
     search_string = f"{str(number_prefix).rjust(3, '0')}_"
 
     # LSCAT
-    os.system('clear')
-    arg = f'{KONEKODIR}/{artist_user_id}/{current_page_num}/{search_string}*'
-    os.system(f'kitty +kitten icat --silent {arg}')
+    thumbnails = glob(f'{KONEKODIR}/{artist_user_id}/{current_page_num}/{search_string}*')
+    if thumbnails:
+        lscat.show_single(thumbnails[0], clear=True)
 
     url = pure.url_given_size(post_json, 'large')
     filename = pure.split_backslash_last(url)
@@ -358,9 +624,8 @@ def display_image(post_json, artist_user_id, number_prefix, current_page_num):
     # received
 
     # LSCAT
-    os.system('clear')
-    arg = f'{KONEKODIR}/{artist_user_id}/{current_page_num}/large/{filename}'
-    os.system(f'kitty +kitten icat --silent {arg}')
+    lscat.show_single(f'{large_dir}{filename}', clear=True)
+    return f'{large_dir}{filename}'
 
 
 class Image:
@@ -371,17 +636,28 @@ class Image:
         p -- view previous image in post (same as above)
         d -- download this image
         o -- open pixiv post in browser
+        + -- zoom in (also =)
+        - -- zoom out
+        arrow keys -- move around when zoomed in
         h -- show keybindings
         m -- show this manual
 
         q -- quit (with confirmation)
 
     """
-    def __init__(self, image_id, idata, current_page_num=1, firstmode=False):
+    def __init__(self, image_id, idata, current_page_num=1, firstmode=False,
+                 displayed=None):
         self.data = idata
         self._image_id = image_id
         self._current_page_num = current_page_num
         self._firstmode = firstmode
+        # The first image, if it's not in idata.large_dir (display_image)
+        self._displayed = displayed
+        self._zoom = None
+
+    def snapshot(self):
+        """Only saved from view post mode (mode 2); galleries save themselves"""
+        return '2', {'image_id': self._image_id, 'post': self.data.record()}, {}
 
     def open_image(self):
         link = f'https://www.pixiv.net/artworks/{self._image_id}'
@@ -397,6 +673,47 @@ class Image:
         download.download_image_verified(url=large_url, filename=filename,
                                          filepath=filepath)
 
+    def _filepath(self):
+        """The image being displayed"""
+        if self._displayed and self.data.img_post_page_num == 0:
+            return self._displayed  # Opened from a gallery
+        if self.data.downloaded_images:  # Multi-image post
+            return self.data.filepath()
+        return f'{self.data.large_dir}{self.data.filename}'
+
+    def zoom(self, steps):
+        """Zoom in by steps (out if negative); zoomed out fully is the normal view"""
+        if not self._zoom:
+            if steps < 0:
+                print('Not zoomed in!')
+                return
+            if not lscat.Zoom.available():
+                print('Zooming needs a terminal that reports its size in pixels!')
+                return
+            self._zoom = lscat.Zoom(self._filepath())
+            steps -= 1  # Starts zoomed in by one
+            if not self._zoom.zoomed():
+                self._zoom = None
+                print('The image is already shown at full size!')
+                return
+
+        level = self._zoom.level
+        self._zoom.zoom(steps)
+        if not self._zoom.zoomed():
+            self._zoom = None
+            lscat.show_single(self._filepath(), clear=True)
+        elif self._zoom.level == level and steps:
+            print('The image is already shown at full size!')
+        else:
+            self._zoom.render()
+
+    def pan(self, right, down):
+        if not self._zoom:
+            print('Zoom in first! (+)')
+            return
+        self._zoom.pan(right, down)
+        self._zoom.render()
+
     def next_image(self):
         if not self.data.page_urls:
             print('This is the only page in the post!')
@@ -405,6 +722,7 @@ class Image:
 
         else:
             self.data.img_post_page_num += 1  # Be careful of 0 index
+            self._zoom = None
             self._go_next_image()
 
     def _go_next_image(self):
@@ -443,7 +761,8 @@ class Image:
             print('This is the first image in the post!')
         else:
             self.data.img_post_page_num -= 1
-            utils.display_image_vp(f'{self.data.large_dir}{self.data.image_filename()}')
+            self._zoom = None
+            utils.display_image_vp(self._filepath())
             print(f'Page {self.data.img_post_page_num+1}/{self.data.number_of_pages}')
 
     def leave(self, force=False):
@@ -461,6 +780,9 @@ class Users(ABC):
     User view commands (No need to press enter):
         n -- view next page
         p -- view previous page
+        g -- go to a page
+        j -- scroll down one artist (needs viewport = on in [Lscat] of the config)
+        k -- scroll up one artist
         r -- delete all cached images, re-download and reload view
         h -- show keybindings
         m -- show this manual
@@ -475,73 +797,152 @@ class Users(ABC):
         self._input = user_or_id
         self._offset = 0
         self._page_num = 1
+        self._last_page_num = None  # Once it's known
+        self._fetched = {}  # Page number: json of a page ahead, for _top_up
         self.download_path = f'{self._main_path}/{self._input}/{self._page_num}'
         self._show = True
+        self._viewport = None
         self.data: 'data.UserJson'
+        self._mode: str
 
     def start(self):
         # It can't show first (including if cache is outdated),
         # because it needs to print the right message
         # Which means parsing is needed first
-        self._parse_and_download()
-        if self._show:
+        error = self._parse_and_download()
+        if self._show and Path(self.download_path).is_dir():
             self._show_page()
-        self._prefetch_next_page()
+        if error:
+            print(f'Page {self._page_num} failed to download ({error!r}), try again')
+        self._top_up()
+        session.track(self)
+        session.checkpoint()
+
+    def resume(self, saved):
+        """
+        Like start(), but for the page in a session.Saved of snapshot(), which
+        is shown from the cache without any requests
+        """
+        self._page_num = saved.state['page_num']
+        self._offset = saved.state['offset']
+        self.download_path = f'{self._main_path}/{self._input}/{self._page_num}'
+        self.data = data.UserJson.restore(saved.state['data'], fetch=self._refetch,
+                                          max_pages=utils.pages_in_memory())
+        if not Path(self.download_path).is_dir():  # Cache has been cleared
+            self.start()
+            return
+        self._show_page()
+        self._top_up()
+        session.track(self)
+
+    def snapshot(self):
+        """(mode, state, sections) to save the session with"""
+        state = {'input': self._input, 'page_num': self._page_num,
+                 'offset': self._offset, 'data': self.data.snapshot()}
+        return self._mode, state, {}
 
     def _parse_and_download(self):
         """
         Parse info, combine profile pics and previews, download all concurrently,
-        move the profile pics to the correct dir (less files to move)
+        move the profile pics to the correct dir (less files to move).
+        Returns the error if the download failed (see _download_pbar)
         """
         self._parse_user_infos()
-        preview_path = f'{self._main_path}/{self._input}/{self._page_num}/previews/'
 
         # Similar to logic in GalleryLikeMode (_init_download())...
         if not Path(self.download_path).is_dir():
-            self._download_pbar(preview_path)
-
-        elif not (self.data.all_names(self._page_num)[0]
-                  in sorted(os.listdir(self.download_path))[0]):
+            return self._download_pbar()
 
-            print('Cache is outdated, reloading...')
-            # Remove old images
-            os.system(f'rm -r {self.download_path}') # shutil.rmtree is better
-            self._download_pbar(preview_path)
+        elif self._outdated(self.data, self._page_num, self.download_path):
+            print('Cache is outdated, updating...')
             self._show = True
+            return self._download_pbar()
+        return None
 
-    def _download_pbar(self, preview_path):
+    @staticmethod
+    def _outdated(udata, page_num, download_path):
+        """Whether the page downloaded at download_path isn't the one in udata"""
+        if manifest := cache.read_manifest(download_path):
+            return manifest != udata.manifest(page_num)
+        # Downloaded before manifests
+        return not (udata.all_names(page_num)[0]
+                    in sorted(os.listdir(download_path))[0])
+
+    def _download_pbar(self):
+        """Returns the error if the download failed; the page is left as it was"""
         pbar = tqdm(total=len(self.data.all_urls()), smoothing=0)
-        download.async_download_core(
-            preview_path,
-            self.data.all_urls(),
-            rename_images=True,
-            file_names=self.data.all_names(self._page_num),
-            pbar=pbar
-        )
-        pbar.close()
+        try:
+            self._download(self.data, self._page_num, self.download_path, pbar=pbar)
+        except Exception as err:
+            return err
+        finally:
+            pbar.close()
+        return None
 
-        # Move artist profile pics to their correct dir
-        to_move = sorted(os.listdir(preview_path))[:self.data.splitpoint()]
-        with pure.cd(self.download_path):
-            [os.rename(f'{self.download_path}/previews/{pic}',
-                       f'{self.download_path}/{pic}')
-             for pic in to_move]
+    @staticmethod
+    def _download(udata, page_num, download_path, pbar=None, progress=None):
+        """
+        Rebuild the page directory with cache.refreshing: the profile pics and
+        previews of artists that haven't changed are kept, even if they've
+        moved, and only the rest are downloaded. Skipped if another instance
+        has just done it. progress is a Prefetch
+        """
+        with cache.refreshing(download_path, udata.manifest(page_num)) as (
+                staging, missing):
+            if not staging:
+                return
+            if pbar:
+                pbar.total = len(missing)
+                pbar.refresh()
+            if progress:
+                progress.expect(len(missing))
+            download.download_files(
+                staging,
+                [entry['url'] for entry in missing],
+                [entry['file'] for entry in missing],
+                pbar=pbar,
+                on_done=progress.add if progress else None
+            )
 
 
     @abstractmethod
-    def _pixivrequest(self):
+    def _pixivrequest(self, offset):
         """Blank method, classes that inherit this ABC must override this"""
         raise NotImplementedError
 
+    def _refetch(self, page_num):
+        """Request a page again, once it's been evicted from memory"""
+        return self._pixivrequest((page_num - 1) * 30)
+
     @pure.spinner('Parsing info...')
     def _parse_user_infos(self):
-        """Parse json and get list of artist names, profile pic urls, and id"""
-        result = self._pixivrequest()
+        """
+        Parse json and get list of artist names, profile pic urls, and id.
+        The pages ahead are requested at the same time, for _top_up
+        """
+        pages = fan_out(self._pixivrequest,
+                        range(self._page_num, self._page_num + LOOKAHEAD_PAGES + 1))
+        result = pages.pop(self._page_num)
+        if self._page_num > 1 and not result.get('user_previews'):
+            raise LastPageException
+        self._found_last_page({self._page_num: result, **pages})
+        self._fetched = pages
         if not hasattr(self, 'data'):
-            self.data = data.UserJson(result, self._page_num)
+            self.data = data.UserJson(result, self._page_num, fetch=self._refetch,
+                                      max_pages=utils.pages_in_memory())
         else:
             self.data.update(result, self._page_num)
 
+    def _found_last_page(self, pages):
+        """Note the last page number, if fan_out got that far"""
+        last_num = max(pages)
+        if pages[last_num].get('user_previews') and not pages[last_num].get('next_url'):
+            self._last_page_num = last_num
+        elif not pages[last_num].get('user_previews') and last_num - 1 in pages:
+            self._last_page_num = last_num - 1
+        elif last_num == 1:  # Empty list
+            self._last_page_num = 0
+
     def _show_page(self):
         try:
             names = self.data.names(self._page_num)
@@ -555,46 +956,172 @@ class Users(ABC):
             names_prefixed = list(names_prefixed)
 
             # LSCAT
-            lscat.Card(
-                self.download_path,
-                f'{self._main_path}/{self._input}/{self._page_num}/previews/',
-                messages=names_prefixed,
-            ).render()
-
-    def _prefetch_next_page(self):
-        # TODO: split into download and data parts
-        oldnum = self._page_num
-
-        if self.data.next_url:
-            next_offset = api.myapi.parse_next(self.data.next_url)['offset']
-            # Won't download if not immediately next page, eg
-            # p1 (p2 downloaded) -> p2 (p3) -> p1 -> p2 (p4 won't download)
-            if int(next_offset) - int(self._offset) <= 30:
-                self._offset = next_offset
-                self._page_num = int(self._offset) // 30 + 1
-                self.download_path = f'{self._main_path}/{self._input}/{self._page_num}'
-
-                self._parse_and_download()
-
-        self._page_num = oldnum
-        self.download_path = f'{self._main_path}/{self._input}/{self._page_num}'
+            with cache.page_lock(self.download_path, shared=True):
+                card = lscat.Card(
+                    self.download_path,
+                    f'{self._main_path}/{self._input}/{self._page_num}/previews/',
+                    messages=names_prefixed,
+                )
+                if utils.config_section('Lscat').getboolean('viewport',
+                                                            fallback=False):
+                    # Only the artists that fit on the screen; scroll for more
+                    self._viewport = lscat.Viewport(card)
+                    self._viewport.render()
+                else:
+                    card.render()
+
+    def scroll(self, artists):
+        if not self._viewport:
+            print('Set "viewport = on" in the [Lscat] section of the config to scroll!')
+            return
+        with cache.page_lock(self.download_path, shared=True):
+            if not self._viewport.scroll(artists):
+                print('Cannot scroll further!')
+
+    def _top_up(self):
+        """
+        Keep the LOOKAHEAD_PAGES pages after the current one fetched and
+        downloaded in the background, like AbstractGallery._top_up. Every page
+        is requested by its own offset, so they don't wait for each other;
+        ones fetched with the current page (by fan_out) aren't requested again
+        """
+        prefix = f'{self._main_path}/{self._input}/'
+        focus_prefetches(prefix)
+        estimate = dir_bytes(self.download_path)
+        for page_num in range(self._page_num + 1, self._page_num + LOOKAHEAD_PAGES + 1):
+            if self._last_page_num and page_num > self._last_page_num:
+                return
+            download_path = f'{prefix}{page_num}'
+            if download_path in PREFETCHES or page_num in self.data.pages_cache:
+                continue
+            if not within_budget(prefix, estimate):
+                return
+            PREFETCHES[download_path] = Prefetch(self._fetch_page(
+                page_num, download_path, self._fetched.pop(page_num, None)))
+
+    def _fetch_page(self, page_num, download_path, page=None):
+        """The job of a Prefetch; page is its json, if it's been fetched already"""
+        def fetch(progress):
+            nonlocal page
+            if page is None:
+                page = self._pixivrequest((page_num - 1) * 30)
+            progress.fetched(page)
+            if not page.get('user_previews'):
+                return None  # Past the last page
+            udata = data.UserJson(page, page_num)
+            if (not Path(download_path).is_dir()
+                    or self._outdated(udata, page_num, download_path)):
+                self._download(udata, page_num, download_path, progress=progress)
+            return page
+        return fetch
+
+    def _finish_prefetch(self, page_num):
+        """
+        Add a prefetched page to self.data, waiting for it if need be.
+        Returns whether it didn't fail
+        """
+        prefetch = PREFETCHES.pop(f'{self._main_path}/{self._input}/{page_num}', None)
+        if not prefetch:
+            return True
+        try:
+            page = prefetch.wait()
+        except futures.CancelledError:  # Nothing failed, prefetch it again
+            forget_prefetches(f'{self._main_path}/{self._input}/')
+            self._top_up()
+            return self._finish_prefetch(page_num)
+        except Exception as err:  # Prefetched again by the next _top_up
+            print(f'Page {page_num} failed to download ({err!r}), try again')
+            return False
+        if page:
+            self.data.update(page, page_num)
+            if not page['next_url']:
+                self._last_page_num = page_num
+        else:
+            self._last_page_num = page_num - 1
+        return True
 
     def next_page(self):
+        self._top_up()  # In case it was cancelled
+        if not self._finish_prefetch(self._page_num + 1):
+            return
         self._page_num += 1
         self.download_path = f'{self._main_path}/{self._input}/{self._page_num}'
         self._show_page()
+        self._offset = (self._page_num - 1) * 30
 
-        self._prefetch_next_page()
+        self._top_up()
+        session.checkpoint()
 
     def previous_page(self):
         if self._page_num > 1:
             self._page_num -= 1
-            self._offset = int(self._offset) - 30
+            self._offset = (self._page_num - 1) * 30
             self.download_path = f'{self._main_path}/{self._input}/{self._page_num}'
             self._show_page()
+            session.checkpoint()
         else:
             print('This is the first page!')
 
+    def go_to_page(self):
+        """Jump to a page, asked for"""
+        answer = input('Go to page: ')
+        if answer.isdigit() and int(answer) >= 1:
+            self._jump(int(answer))
+        else:
+            print('Invalid number!')
+        prompt.user_prompt(self)
+
+    def _jump(self, page_num):
+        """
+        The page is requested along with the pages ahead of it, at once.
+        If it's past the last page, the pages in between are requested (by
+        fan_out, so a batch at a time) to find the last page, and that's shown
+        """
+        if self._last_page_num is not None and page_num > self._last_page_num:
+            print(f'Page {self._last_page_num} is the last page!')
+            page_num = max(self._last_page_num, 1)
+        if page_num == self._page_num:
+            self._show_page()
+            return
+        if page_num == self._page_num + 1:
+            self.next_page()
+            return
+
+        forget_prefetches(f'{self._main_path}/{self._input}/')
+        previous_page_num = self._page_num
+        self._set_page(page_num)
+        # Pages seen already are shown from the cache, like previous_page
+        if not (page_num in self.data.pages_cache
+                and Path(self.download_path).is_dir()):
+            try:
+                error = self._parse_and_download()
+            except LastPageException:
+                self._set_page(previous_page_num)
+                self._find_last_page(page_num)
+                self._jump(page_num)
+                return
+            if error:  # Stay on the previous page
+                self._set_page(previous_page_num)
+                self._show_page()
+                print(f'Page {page_num} failed to download ({error!r}), try again')
+                return
+
+        self._show_page()
+        self._top_up()
+        session.checkpoint()
+
+    def _set_page(self, page_num):
+        self._page_num = page_num
+        self._offset = (page_num - 1) * 30
+        self.download_path = f'{self._main_path}/{self._input}/{page_num}'
+
+    @pure.spinner('Finding the last page...')
+    def _find_last_page(self, past_page_num):
+        """Between the current page and past_page_num, which is past the last"""
+        pages = fan_out(self._pixivrequest, range(self._page_num + 1, past_page_num))
+        self._last_page_num = max([self._page_num] + [
+            page_num for (page_num, page) in pages.items() if page.get('user_previews')])
+
     def go_artist_mode(self, selected_user_num):
         try:
             artist_user_id = self.data.artist_user_id(self._page_num, selected_user_num)
@@ -609,7 +1136,8 @@ class Users(ABC):
     def reload(self):
         ans = input('This will delete cached images and redownload them. Proceed?\n')
         if ans == 'y' or not ans:
-            os.system(f'rm -r {self._main_path}') # shutil.rmtree is better
+            drop_prefetches(f'{self._main_path}/{self._input}/')
+            cache.remove_all(self._main_path)
             self.__init__(self._input)
             self.start()
         prompt.user_prompt(self)
@@ -622,10 +1150,11 @@ class SearchUsers(Users):
     """
     def __init__(self, user):
         self._main_path = f'{KONEKODIR}/search'
+        self._mode = '4'
         super().__init__(user)
 
-    def _pixivrequest(self):
-        return api.myapi.search_user_request(self._input, self._offset)
+    def _pixivrequest(self, offset):
+        return api.myapi.search_user_request(self._input, offset)
 
 class FollowingUsers(Users):
     """
@@ -636,7 +1165,8 @@ class FollowingUsers(Users):
     def __init__(self, your_id, publicity='private'):
         self._publicity = publicity
         self._main_path = f'{KONEKODIR}/following'
+        self._mode = '3'
         super().__init__(your_id)
 
-    def _pixivrequest(self):
-        return api.myapi.following_user_request(self._input, self._publicity, self._offset)
+    def _pixivrequest(self, offset):
+        return api.myapi.following_user_request(self._input, self._publicity, offset)
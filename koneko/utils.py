@@ -1,13 +1,13 @@
 import os
 import imghdr
-import shutil
 from getpass import getpass
 from pathlib import Path
 from configparser import ConfigParser
+from concurrent.futures import ThreadPoolExecutor
 
 import pixcat
 
-from koneko import __version__, KONEKODIR, main, pure, lscat
+from koneko import __version__, KONEKODIR, main, pure, lscat, cache, ui
 
 
 def verify_full_download(filepath):
@@ -26,17 +26,20 @@ def show_artist_illusts(path, renderer='lscat', **kwargs):
     if renderer != 'lscat':
         lscat_path = os.getcwd()
 
-    with pure.cd(path):
+    # Shared lock: another instance can't delete this page while rendering
+    with cache.page_lock(path, shared=True):
         if renderer == 'lscat':
             lscat.Gallery(path, **kwargs).render()
         elif renderer == 'lscat old':
-            os.system(f'{Path(lscat_path).parent}/legacy/lscat')
+            with pure.cd(path):
+                os.system(f'{Path(lscat_path).parent}/legacy/lscat')
         elif renderer == 'lsix':
-            os.system(f'{Path(lscat_path).parent}/legacy/lsix')
+            with pure.cd(path):
+                os.system(f'{Path(lscat_path).parent}/legacy/lsix')
 
 
 def display_image_vp(filepath):
-    os.system(f'kitty +kitten icat --silent {filepath}')
+    lscat.show_single(filepath)
 
 
 # - Prompt functions
@@ -76,7 +79,7 @@ def artist_user_id_prompt():
 
 @pure.catch_ctrl_c
 def show_man_loop():
-    os.system('clear')
+    pure.clear_screen()
     print(main.__doc__)
     print(' ' * 3, '=' * 30)
     print(main.ArtistGallery.__doc__)
@@ -89,7 +92,7 @@ def show_man_loop():
     while True:
         help_command = input('\n\nEnter any key to return: ')
         if help_command or help_command == '':
-            os.system('clear')
+            pure.clear_screen()
             break
 
 
@@ -100,18 +103,18 @@ def clear_cache_loop():
     while True:
         help_command = input('\nEnter y to confirm: ')
         if help_command == 'y':
-            shutil.rmtree('/tmp/koneko/')
-            os.system('clear')
+            cache.remove_all(KONEKODIR)
+            pure.clear_screen()
             break
         else:
             print('Operation aborted!')
-            os.system('clear')
+            pure.clear_screen()
             break
 
 
 @pure.catch_ctrl_c
 def info_screen_loop():
-    os.system('clear')
+    pure.clear_screen()
     messages = (
         '',
         f'koneko こねこ version {__version__} beta\n',
@@ -143,10 +146,100 @@ def info_screen_loop():
     while True:
         help_command = input('\nEnter any key to return: ')
         if help_command or help_command == '':
-            os.system('clear')
+            pure.clear_screen()
             break
 
 
+def cache_command(args):
+    """`koneko cache ...`, args are from cli.process_cache_args()"""
+    if args['check']:
+        check_cache(repair=not args['--dry-run'])
+    elif args['compress']:
+        compress_cache(int(args['--quality']), int(args['--days']))
+
+
+def check_cache(repair=True):
+    """`koneko cache check`: validate the whole cache and report broken files"""
+    print(f'Checking {KONEKODIR}...')
+    broken = cache.check(KONEKODIR, repair=repair)
+
+    for (filepath, reason) in broken:
+        print(f'{filepath}: {reason}')
+
+    if not broken:
+        print('No problems found!')
+    elif repair:
+        print(f'Removed {len(broken)} broken entries; '
+              'they will be downloaded again when viewed')
+    else:
+        print(f'Found {len(broken)} broken entries')
+
+
+def compress_cache(quality, cold_days):
+    """`koneko cache compress`: re-encode cold cached images to WebP"""
+    print(f'Compressing images in {KONEKODIR} not viewed for {cold_days} days...')
+    saved = cache.compress(KONEKODIR, quality, cold_days)
+    if saved is None:
+        print('Already running in another instance!')
+    else:
+        print(f'Saved {saved / 1024 / 1024:.1f} MiB')
+
+
+def start_background_jobs():
+    """Cache maintenance that the config file asks to run on every startup"""
+    settings = config_section('Cache')
+    if settings.getboolean('compress', fallback=False):
+        cache.compress_in_background(
+            settings.getint('compress_quality', fallback=80),
+            settings.getint('compress_after_days', fallback=7),
+        )
+
+
+def pages_in_memory():
+    """How many pages of api data to keep in memory; the rest are refetched"""
+    return config_section('Cache').getint('pages_in_memory', fallback=8)
+
+
+def configure_lscat():
+    """Optional settings for lscat, from the [Lscat] section of the config file"""
+    payload = config_section('Lscat').get('payload', fallback=lscat.PAYLOAD)
+    if payload in lscat.PAYLOADS:
+        lscat.PAYLOAD = payload
+
+
+def configure_prefetch():
+    """
+    Optional settings for prefetching pages ahead, from the [Prefetch] section
+    of the config file:
+        pages        how many pages ahead of the current one [default: 1]
+        max_mb       the most that pages ahead can take up [default: 64]
+        concurrency  how many pages to download at once [default: 2]
+        fan_out      how many pages of a user list to request at once [default: 8]
+    Only called at start up: it replaces the thread pools, without shutting
+    down the ones that prefetches may still be using
+    """
+    settings = config_section('Prefetch')
+    ui.LOOKAHEAD_PAGES = max(1, settings.getint('pages', fallback=ui.LOOKAHEAD_PAGES))
+    ui.LOOKAHEAD_BYTES = settings.getint('max_mb', fallback=64) * 2**20
+    ui.Prefetch.POOL = ThreadPoolExecutor(
+        max_workers=max(1, settings.getint('concurrency', fallback=2)))
+    ui.FAN_OUT = max(1, settings.getint('fan_out', fallback=ui.FAN_OUT))
+    ui.REQUESTS = ThreadPoolExecutor(max_workers=ui.FAN_OUT)
+
+
+def config_section(section):
+    """
+    Returns a section of the config file, eg to read optional settings with
+    config_section('Cache').getint('compress_quality', fallback=80).
+    It's empty if the section (or the config file) doesn't exist
+    """
+    config_object = ConfigParser()
+    config_object.read(Path('~/.config/koneko/config.ini').expanduser())
+    if not config_object.has_section(section):
+        config_object.add_section(section)
+    return config_object[section]
+
+
 def config():
     config_object = ConfigParser()
     if Path('~/.config/koneko/config.ini').expanduser().exists():
@@ -178,6 +271,6 @@ def config():
 
         credentials = config_object['Credentials']
 
-        os.system('clear')
+        pure.clear_screen()
 
     return credentials, your_id
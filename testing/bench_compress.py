@@ -0,0 +1,83 @@
+"""
+Bytes saved vs added decode time of `koneko cache compress`, on the sample
+images in testing/ (or any images given as arguments).
+
+Run in main koneko dir:
+    python -m testing.bench_compress [--quality=<q>] [image ...]
+
+Decode time is measured for what lscat does with a cached thumbnail
+(decode + fit to 310px), and for a full decode (image view).
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+import timeit
+
+from PIL import Image
+
+from koneko import cache, lscat
+
+REPEAT = 10
+
+
+def decode_thumbnail(filepath):
+    with Image.open(filepath) as image:
+        lscat.fit(image, 310)
+
+
+def decode_full(filepath):
+    with Image.open(filepath) as image:
+        image.load()
+
+
+def best_time(func, filepath):
+    """Best of REPEAT runs, in ms"""
+    return min(timeit.repeat(lambda: func(filepath), number=1, repeat=REPEAT)) * 1000
+
+
+def bench(filepath, quality, tempdir):
+    copy = shutil.copy(filepath, tempdir)
+    old_size = os.path.getsize(copy)
+    old_thumb, old_full = best_time(decode_thumbnail, copy), best_time(decode_full, copy)
+
+    cache.recompress_image(copy, quality)
+    new_size = os.path.getsize(copy)
+    new_thumb, new_full = best_time(decode_thumbnail, copy), best_time(decode_full, copy)
+
+    return (os.path.basename(filepath), old_size, new_size,
+            new_thumb - old_thumb, new_full - old_full)
+
+
+def main():
+    quality = 80
+    files = []
+    for arg in sys.argv[1:]:
+        if arg.startswith('--quality='):
+            quality = int(arg.split('=')[1])
+        else:
+            files.append(arg)
+    if not files:
+        files = [os.path.join('testing', f) for f in lscat.filter_jpg('testing')]
+
+    print(f'WebP quality {quality}, best of {REPEAT} decodes\n')
+    print(f"{'file':<24} {'bytes':>10} {'webp':>10} {'saved':>7}"
+          f" {'+thumb ms':>10} {'+full ms':>10}")
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        results = [bench(f, quality, tempdir) for f in files]
+
+    for (name, old_size, new_size, thumb, full) in results:
+        saved = (1 - new_size / old_size) * 100
+        print(f'{name[:24]:<24} {old_size:>10} {new_size:>10} {saved:>6.1f}%'
+              f' {thumb:>+10.2f} {full:>+10.2f}')
+
+    old_total = sum(r[1] for r in results)
+    new_total = sum(r[2] for r in results)
+    print(f"\n{'total':<24} {old_total:>10} {new_total:>10}"
+          f" {(1 - new_total / old_total) * 100:>6.1f}%")
+
+
+if __name__ == '__main__':
+    main()
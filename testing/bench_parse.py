@@ -0,0 +1,106 @@
+"""
+Cost of decoding api responses: pixivpy's decoding (every object copied into
+a JsonDict) vs api.parse_json (orjson if installed, plain dicts), on
+testing/page_json.py and larger synthetic pages.
+
+Run in main koneko dir:
+    python -m testing.bench_parse [--repeat=<n>]
+
+For each page, measures decoding alone, and a page load: decoding plus what
+GalleryJson.add_page keeps of it (data.GalleryPage and the IllustTable).
+Peak memory is of a page load, measured separately with tracemalloc
+"""
+
+import sys
+import copy
+import json
+import timeit
+import tracemalloc
+
+from pixivpy3.utils import JsonDict
+
+from koneko import api, data
+from testing.page_json import page_json
+
+REPEAT = 20
+
+
+def pixivpy(content):
+    """What AppPixivAPI.parse_result does"""
+    return json.loads(content.decode(), object_hook=JsonDict)
+
+
+def koneko_json(content):
+    """api.parse_json without orjson"""
+    return api.JsonView(json.loads(content))
+
+
+def synthetic_page(illusts, pages_per_post, tags_per_post, caption_chars):
+    """A page like page_json, but with more (and bigger) posts"""
+    posts = []
+    for i in range(illusts):
+        post = copy.deepcopy(page_json['illusts'][i % len(page_json['illusts'])])
+        post['id'] += i
+        post['caption'] = 'caption ' * (caption_chars // 8)
+        post['tags'] = [{'name': f'tag{i}_{j}', 'translated_name': f'tag {j}'}
+                        for j in range(tags_per_post)]
+        post['page_count'] = pages_per_post
+        post['meta_pages'] = [{'image_urls': dict(post['image_urls'],
+                                                  original=f'{j}.jpg')}
+                              for j in range(pages_per_post if pages_per_post > 1
+                                             else 0)]
+        posts.append(post)
+    return dict(page_json, illusts=posts)
+
+
+def page_load(parse, content):
+    raw = parse(content)
+    data.GalleryPage(raw)
+    data.IllustTable().add(1, raw['illusts'])
+
+
+def best_ms(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat)) * 1000
+
+
+def peak_memory(func):
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    repeat = REPEAT
+    for arg in sys.argv[1:]:
+        if arg.startswith('--repeat='):
+            repeat = int(arg.split('=')[1])
+
+    pages = (
+        ('page_json', page_json),
+        ('30 posts, 10 pages each', synthetic_page(30, 10, 20, 2000)),
+        ('300 posts', synthetic_page(300, 1, 10, 500)),
+    )
+    parsers = (
+        ('pixivpy', pixivpy),
+        ('parse_json, json', koneko_json),
+        ('parse_json' + (', orjson' if api.orjson else ''), api.parse_json),
+    )
+
+    print(f'Best of {repeat}\n')
+    print(f"{'page':<24} {'decoder':<20} {'decode ms':>10} {'load ms':>9}"
+          f" {'peak KiB':>9}")
+    for (page_name, page) in pages:
+        content = json.dumps(page, ensure_ascii=False).encode()
+        for (parser_name, parse) in parsers:
+            decode = best_ms(lambda: parse(content), repeat)
+            load = best_ms(lambda: page_load(parse, content), repeat)
+            peak = peak_memory(lambda: page_load(parse, content))
+            print(f'{page_name[:24]:<24} {parser_name:<20} {decode:>10.2f}'
+                  f' {load:>9.2f} {peak / 1024:>9.0f}')
+        print(f'{len(content)} bytes\n')
+
+
+if __name__ == '__main__':
+    main()
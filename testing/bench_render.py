@@ -0,0 +1,180 @@
+"""
+Cost of lscat renders, measured against a fake terminal that counts what is
+written to it: wall time, CPU time (including the worker threads), bytes,
+number of writes, graphics protocol codes and the peak memory of a render.
+
+Run in main koneko dir:
+    python -m testing.bench_render [--repeat=<n>] [--payload=<png|zlib|smallest>]
+                                   [dir ...]
+
+Galleries are rendered from the images in each dir (default: testing/), and
+cards from a copy of them laid out like a user view. Each is rendered:
+    cold    nothing stored, the terminal holds nothing
+    stored  the stream was stored by the cold render (STREAMS)
+    held    the terminal also still holds the images (REGISTRY)
+
+The fake terminal is 100x30 cells of 10x20 px, so atlas mode is used.
+Peak memory is measured in a separate render with tracemalloc, which is slow
+"""
+
+import os
+import re
+import sys
+import time
+import shutil
+import tempfile
+import tracemalloc
+from collections import Counter
+from contextlib import redirect_stdout
+
+from koneko import lscat
+
+REPEAT = 5
+GEOMETRY = ((100, 30), (1000, 600))
+CELL_PX = (10, 20)
+
+# Controls of one graphics code, eg ESC_Ga=T,f=100,i=1,q=2,m=1;...ESC\
+GRAPHICS = re.compile('\x1b_G([^;]*);')
+
+
+class FakeTerminal:
+    """A stdout that only counts what is written to it"""
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+        self.codes = Counter()  # action: number of codes
+
+    def write(self, text):
+        self.writes += 1
+        self.bytes += len(text.encode())
+        for match in GRAPHICS.finditer(text):
+            controls = dict(kv.split('=') for kv in match.group(1).split(',') if kv)
+            # Continuation chunks of a transmission have no action
+            self.codes[controls.get('a', 'chunk')] += 1
+        return len(text)
+
+    def flush(self):
+        pass
+
+
+def fresh_registry():
+    lscat.REGISTRY = lscat.ImageRegistry()
+
+
+def fresh_streams(tempdir):
+    lscat.STREAMS = lscat.StreamCache(tempfile.mkdtemp(dir=tempdir))
+
+
+def measure(render):
+    """Render once into a FakeTerminal; returns (wall ms, cpu ms, terminal)"""
+    terminal = FakeTerminal()
+    with redirect_stdout(terminal):
+        wall, cpu = time.perf_counter(), time.process_time()
+        render()
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+    return wall * 1000, cpu * 1000, terminal
+
+
+def peak_memory(render):
+    tracemalloc.start()
+    with redirect_stdout(FakeTerminal()):
+        render()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def bench(render, tempdir, repeat):
+    """Yields (scenario, best wall, best cpu, terminal, peak memory)"""
+    def cold():
+        fresh_registry()
+        fresh_streams(tempdir)
+
+    def stored():
+        fresh_registry()
+        fresh_streams(tempdir)
+        with redirect_stdout(FakeTerminal()):
+            render()
+        fresh_registry()
+
+    def held():
+        fresh_registry()
+        fresh_streams(tempdir)
+        with redirect_stdout(FakeTerminal()):
+            render()
+
+    for (scenario, setup) in (('cold', cold), ('stored', stored), ('held', held)):
+        runs = []
+        for _ in range(repeat):
+            setup()
+            runs.append(measure(render))
+        setup()
+        peak = peak_memory(render)
+
+        wall = min(run[0] for run in runs)
+        cpu = min(run[1] for run in runs)
+        yield scenario, wall, cpu, runs[-1][2], peak
+
+
+def ext(filepath):
+    return os.path.splitext(filepath)[1]
+
+
+def card_fixture(images, tempdir):
+    """A user view page: one artist per image, previewing the same images"""
+    path = os.path.join(tempdir, 'card')
+    previews = os.path.join(path, 'previews')
+    os.makedirs(previews)
+    number = len(images)
+    for (i, image) in enumerate(images):
+        shutil.copy(image, os.path.join(path, f'{i:03}_artist{ext(image)}'))
+        for j in range(3):
+            preview = images[(i + j) % len(images)]
+            shutil.copy(preview,
+                        os.path.join(previews, f'{number:03}_preview{ext(preview)}'))
+            number += 1
+    messages = [f'{i:02}\tartist' for i in range(len(images))]
+    return lambda: lscat.Card(path, previews, messages).render()
+
+
+def main():
+    repeat = REPEAT
+    dirs = []
+    for arg in sys.argv[1:]:
+        if arg.startswith('--repeat='):
+            repeat = int(arg.split('=')[1])
+        elif arg.startswith('--payload='):
+            lscat.PAYLOAD = arg.split('=')[1]
+        else:
+            dirs.append(arg)
+    dirs = dirs or ['testing']
+
+    lscat.terminal_geometry = lambda: GEOMETRY
+    lscat.cell_size = lambda: CELL_PX
+
+    print(f'Best of {repeat} renders, {lscat.PAYLOAD} payloads\n')
+    print(f"{'render':<28} {'scenario':<8} {'wall ms':>9} {'cpu ms':>9}"
+          f" {'bytes':>10} {'writes':>7} {'a=T':>5} {'a=p':>5} {'chunks':>7}"
+          f" {'peak KiB':>9}")
+
+    with tempfile.TemporaryDirectory() as tempdir:
+        for path in dirs:
+            path = os.path.abspath(path)
+            images = [os.path.join(path, f) for f in lscat.filter_jpg(path)]
+            renders = (
+                (f'Gallery {os.path.basename(path)}',
+                 lambda: lscat.Gallery(path).render()),
+                (f'Card {os.path.basename(path)}',
+                 card_fixture(images, tempfile.mkdtemp(dir=tempdir))),
+            )
+            for (name, render) in renders:
+                for (scenario, wall, cpu, terminal, peak) in bench(render, tempdir,
+                                                                   repeat):
+                    print(f'{name[:28]:<28} {scenario:<8} {wall:>9.2f} {cpu:>9.2f}'
+                          f' {terminal.bytes:>10} {terminal.writes:>7}'
+                          f" {terminal.codes['T']:>5} {terminal.codes['p']:>5}"
+                          f" {terminal.codes['chunk']:>7} {peak / 1024:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
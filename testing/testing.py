@@ -1,8 +1,14 @@
 import os
+import json
+import time
+import zlib
+import threading
+from pathlib import Path
 
 import pytest
+from PIL import Image
 
-from koneko import pure, lscat, utils
+from koneko import api, pure, lscat, utils, cache, data, session, ui, download, main
 from page_json import *  # Imports the current_page (dict) stored in disk
 
 page_illusts = page_json["illusts"]
@@ -139,3 +145,741 @@ def test_artist_user_id_prompt(monkeypatch):
     )
     myinput = utils.artist_user_id_prompt()
     assert myinput == "https://www.pixiv.net/en/users/2232374"
+
+
+def test_page_cells():
+    page = (("a.jpg", "b.jpg"), ("c.jpg",), None)
+    assert lscat.page_cells(page, (0, 9, 18), range(2), [2, 20], "dir") == [
+        ("dir/a.jpg", 2, 0),
+        ("dir/b.jpg", 20, 0),
+        ("dir/c.jpg", 2, 9),
+    ]
+
+
+def test_make_atlas():
+    cells = [
+        ("testing/04_祝！！！.jpg", 2, 0),
+        ("testing/77803142_p0.png", 20, 0),
+        ("testing/17_ミコニャン.jpg", 2, 9),
+    ]
+    atlas, x, y = lscat.make_atlas(cells, (10, 20), size=100)
+    assert (x, y) == (2, 0)
+    assert atlas.mode == "RGBA"
+    # Every thumbnail fits in 100x100, the second starts 18 cells to the right
+    assert 18 * 10 < atlas.width <= 18 * 10 + 100
+    assert atlas.height == 9 * 20 + 100
+
+
+# From cache.py
+def test_publishing(tmp_path):
+    page = tmp_path / "123" / "1"
+    with cache.publishing(page) as staging:
+        (Path(staging) / "001_a.jpg").touch()
+        assert not page.is_dir()  # Not published until complete
+    assert os.listdir(page) == ["001_a.jpg"]
+
+    # Already published by someone else, reuse it
+    with cache.publishing(page) as staging:
+        assert staging is None
+
+    cache.remove_all(tmp_path / "123")
+    assert not (tmp_path / "123").exists()
+
+
+def test_refreshing(tmp_path):
+    page = tmp_path / "following" / "1"
+    manifest = [{"id": 1, "url": "https://x/1.jpg", "file": "000_a.jpg"},
+                {"id": 10, "url": "https://x/10.jpg", "file": "previews/001_10.jpg"}]
+    with cache.refreshing(page, manifest) as (staging, missing):
+        assert missing == manifest  # Nothing to keep
+        for entry in missing:
+            (Path(staging) / entry["file"]).write_text(entry["url"])
+        assert not page.is_dir()
+    assert cache.read_manifest(page) == manifest
+
+    # Artist 2 came first, artist 1's preview is new
+    new = [{"id": 2, "url": "https://x/2.jpg", "file": "000_b.jpg"},
+           {"id": 1, "url": "https://x/1.jpg", "file": "001_a.jpg"},
+           {"id": 11, "url": "https://x/11.jpg", "file": "previews/002_11.jpg"}]
+    with cache.refreshing(page, new) as (staging, missing):
+        assert [entry["id"] for entry in missing] == [2, 11]
+        assert (Path(staging) / "001_a.jpg").read_text() == "https://x/1.jpg"
+        for entry in missing:
+            (Path(staging) / entry["file"]).write_text(entry["url"])
+    assert sorted(os.listdir(page)) == [".manifest", "000_b.jpg", "001_a.jpg", "previews"]
+    assert os.listdir(page / "previews") == ["002_11.jpg"]
+
+    with cache.refreshing(page, new) as (staging, missing):
+        assert staging is None  # Up to date
+
+    # A file that didn't land isn't in the manifest, so it's downloaded next time
+    failed = new + [{"id": 3, "url": "https://x/3.jpg", "file": "003_c.jpg"}]
+    with cache.refreshing(page, failed) as (staging, missing):
+        assert [entry["id"] for entry in missing] == [3]
+    assert cache.read_manifest(page) == new
+
+
+def test_refreshing_across_pages(tmp_path):
+    def entries(ids):
+        return [{"id": i, "url": f"https://x/{i}.jpg", "file": f"{n:03}_{i}.jpg"}
+                for (n, i) in enumerate(ids)]
+
+    def refresh(page, ids):
+        with cache.refreshing(tmp_path / page, entries(ids)) as (staging, missing):
+            for entry in missing:
+                (Path(staging) / entry["file"]).write_text(entry["url"])
+        return [entry["id"] for entry in missing]
+
+    assert refresh("1", [5, 4]) == [5, 4]
+    assert refresh("2", [3, 2]) == [3, 2]
+    # A new post shifts every page on by one: 4 goes to the pool, then page 2
+    assert refresh("1", [6, 5]) == [6]
+    assert refresh("2", [4, 3]) == []
+    assert (tmp_path / "2" / "000_4.jpg").read_text() == "https://x/4.jpg"
+    # Deleted: page 1 takes 3 from page 2
+    assert refresh("1", [5, 3]) == []
+
+    broken = tmp_path / "2" / "001_3.jpg"
+    assert cache.forget_files(tmp_path / "2", [broken])
+    assert [entry["id"] for entry in cache.read_manifest(tmp_path / "2")] == [4]
+
+
+def test_download_page_failure(tmp_path, monkeypatch):
+    illusts = page_illusts[:3]
+    broken = pure.medium_urls(illusts)[1]
+
+    def protected_download(url, path):
+        if url == broken:
+            raise ConnectionError
+        (Path(path) / pure.split_backslash_last(url)).write_text(url)
+
+    monkeypatch.setattr(api.myapi, "protected_download", protected_download)
+    page = tmp_path / "1"
+    with pytest.raises(ConnectionError):
+        download.download_page(illusts, page)
+    assert not page.exists()  # Not published as if it were complete
+    assert os.listdir(tmp_path) == [".1.lock"]
+
+    broken = None
+    download.download_page(illusts, page)
+    assert cache.read_manifest(page) == pure.page_manifest(illusts)
+
+
+def test_download_progressive_failure(tmp_path, monkeypatch, capsys):
+    gdata = data.GalleryJson(page_json)
+    gdata.add_page(2, dict(page_json, illusts=page_illusts[:3]))  # Short last page
+    monkeypatch.setattr(main.GalleryLikeMode, "start", lambda self: None)
+    mode = main.ArtistGalleryMode("123", 2, gdata)
+    mode._download_path = str(tmp_path / "2")
+    sizes = []
+
+    class Progressive:
+        def __init__(self, number_of_images):
+            sizes.append(number_of_images)
+
+        def add(self, filepath):
+            pass
+
+        def render(self):
+            return False
+
+    def download_page(illusts, download_path, on_done=None):
+        raise ConnectionError
+
+    monkeypatch.setattr(lscat, "Progressive", Progressive)
+    monkeypatch.setattr(download, "download_page", download_page)
+    mode._download_progressive()  # Doesn't quit koneko
+    assert sizes == [3]
+    assert not mode._show  # There's no page to show
+    assert "Page 2 failed to download" in capsys.readouterr().out
+
+
+def test_check_image(tmp_path):
+    assert cache.check_image("testing/04_祝！！！.jpg") is None
+    assert cache.check_image("testing/77803142_p0.png") is None
+    assert cache.check_image("testing/not_an_image.txt")
+
+    truncated = tmp_path / "001_a.jpg"
+    truncated.write_bytes(Path("testing/04_祝！！！.jpg").read_bytes()[:3000])
+    assert cache.check_image(truncated)
+
+
+def test_check_numbering():
+    assert cache.check_numbering(["000_a.jpg", "001_b.jpg"]) == []
+    assert cache.check_numbering(["000_a.jpg", "002_b.jpg"]) == [1]
+    assert cache.check_numbering(["030_a.jpg", "032_b.jpg"], from_zero=False) == [31]
+    assert cache.check_numbering(["80017594_p0.jpg", "80017594_p1.jpg"]) == []
+
+
+def test_recompress_image(tmp_path):
+    image = tmp_path / "000_a.png"
+    image.write_bytes(Path("testing/77803142_p0.png").read_bytes())
+    old_size = image.stat().st_size
+
+    saved = cache.recompress_image(image, quality=80)
+    assert saved == old_size - image.stat().st_size > 0
+    assert cache.check_image(image) is None
+    assert os.listdir(tmp_path) == ["000_a.png"]  # Same name, no leftovers
+    assert cache.recompress_image(image, quality=80) == 0  # Already WebP
+
+    animated = tmp_path / "001_b.gif"
+    frames = [Image.new("RGB", (64, 64), color) for color in ("red", "blue")]
+    frames[0].save(animated, save_all=True, append_images=frames[1:])
+    original = animated.read_bytes()
+    assert cache.recompress_image(animated, quality=80) == 0
+    assert animated.read_bytes() == original  # Not just its first frame
+
+
+def test_transmit():
+    code = lscat.transmit(b"x" * 4000, a="T", f=100)
+    chunks = code.split("\x1b\\")[:-1]
+    # 4000 bytes -> 5336 bytes of base64 -> two chunks; controls only in the first
+    assert len(chunks) == 2
+    assert chunks[0].startswith("\x1b_Ga=T,f=100,m=1;")
+    assert chunks[1].startswith("\x1b_Gm=0;")
+
+
+def test_stream_cache(tmp_path):
+    streams = lscat.StreamCache(tmp_path, max_bytes=30)
+    files = ["testing/04_祝！！！.jpg", "testing/77803142_p0.png"]
+    key = streams.key(files, ("Gallery", 5))
+    assert key != streams.key(files, ("Gallery", 4))
+    assert streams.get(key) is None
+
+    streams.put(key, {1: 100}, "placements", "full")
+    assert streams.get(key) == ({1: 100}, "placements", "full")
+    os.utime(tmp_path / key, (0, 0))
+    streams.put("newer", {}, "placements")
+    assert streams.get("newer") == ({}, "placements", None)
+    assert streams.get(key) is None  # Over max_bytes, least recently used removed
+
+
+def test_image_registry():
+    registry = lscat.ImageRegistry(quota=250)
+    assert registry.add(1, 100) == ""
+    assert registry.add(2, 100) == ""
+    assert registry.holds_all([1, 2])
+
+    registry.use(1)
+    # 2 is the least recently used, so it's deleted from the terminal
+    assert registry.add(3, 100) == "\x1b_Ga=d,d=I,i=2,q=2;\x1b\\"
+    assert 2 not in registry
+    assert registry.holds_all([1, 3])
+
+
+def test_output_order(capsys, monkeypatch):
+    monkeypatch.setattr(lscat, "REGISTRY", lscat.ImageRegistry())
+
+    def slow_image():
+        time.sleep(0.2)
+        return Image.new("RGB", (1, 1))
+
+    output = lscat.Output()
+    output.image(1, 0, 0, slow_image)
+    output.write("text")
+    output.image(2, 5, 0, lambda: Image.new("RGB", (1, 1)))
+    output.image(1, 10, 0, slow_image)  # Transmitted already, only placed
+    output.emit()
+
+    out = capsys.readouterr().out
+    # Prepared in parallel, but written in the order they were added
+    assert out.index("i=1") < out.index("text") < out.index("i=2")
+    assert out.count("a=T") == 2 and out.count("a=p,i=1") == 1
+    assert output.full() is not None
+
+
+def test_output_keeps_frame_images(capsys, monkeypatch):
+    monkeypatch.setattr(lscat, "REGISTRY", lscat.ImageRegistry(quota=250))
+    lscat.REGISTRY.add(1, 100)
+    lscat.REGISTRY.add(2, 100)
+
+    output = lscat.Output()
+    output.image(1, 0, 0, None)  # Only placed
+    output.image(3, 5, 0, lambda: Image.new("RGB", (5, 5)))  # 100 bytes
+    output.emit()
+
+    out = capsys.readouterr().out
+    # 1 is the least recently used, but this frame places it
+    assert "d=I,i=1," not in out and "d=I,i=2," in out
+    assert lscat.REGISTRY.holds_all([1, 3])
+
+
+def test_fit_within():
+    assert lscat.fit_within((4000, 6000), (1000, 800)) == (533, 800)
+    assert lscat.fit_within((4000, 6000), (300, 800)) == (300, 450)
+    assert lscat.fit_within((100, 100), (1000, 800)) == (100, 100)  # Not enlarged
+
+
+def test_progressive(tmp_path, capsys, monkeypatch):
+    monkeypatch.setattr(lscat, "REGISTRY", lscat.ImageRegistry())
+    for number in range(12):
+        Image.new("RGB", (4, 4)).save(tmp_path / f"{number:03}_title.png")
+
+    gallery = lscat.Progressive(12)
+    assert gallery.cell(0) == (2, 0) and gallery.cell(7) == (38, 9)
+    assert gallery.cell(11) == (20, 0)  # Second page
+
+    # Arrive out of order, second page first
+    for number in (11, 3, 10, *range(10), 1):
+        gallery.add(str(tmp_path / f"{number:03}_title.png"))
+    assert gallery.render()
+
+    out = capsys.readouterr().out
+    assert out.count("a=T") == 12
+    assert out.index(lscat.Progressive.PLACEHOLDER) < out.index("a=T")
+    # Page 2 is only shown after page 1 is complete, then the labels
+    page_2 = out.rindex("\n" * 25)
+    assert out[:page_2].count("a=T") == 10 and out[page_2:].count("a=T") == 2
+    assert out.endswith(lscat.COLUMN_LABELS)
+
+
+def test_progressive_incomplete(tmp_path, capsys):
+    gallery = lscat.Progressive(3)
+    # Every download failed; blocks until the render is over
+    downloader = threading.Thread(target=gallery.add, args=(None,))
+    downloader.start()
+    assert not gallery.render()
+    downloader.join(timeout=5)
+    assert not downloader.is_alive()
+
+
+def test_viewport(tmp_path, capsys, monkeypatch):
+    monkeypatch.setattr(lscat, "REGISTRY", lscat.ImageRegistry())
+    monkeypatch.setattr(lscat, "terminal_geometry", lambda: ((100, 30), (1000, 600)))
+    monkeypatch.setattr(lscat, "cell_size", lambda: (10, 20))
+    for number in range(20):
+        Image.new("RGB", (4, 4)).save(tmp_path / f"{number:03}_title.png")
+
+    viewport = lscat.Viewport(lscat.Gallery(tmp_path, atlas=None))
+    # Each page takes 9 + 16 rows, so only one fits in 30 - 2
+    assert viewport.visible(30, 16) == [0]
+    assert viewport.visible(60, 16) == [0, 1]
+
+    viewport.render()
+    out = capsys.readouterr().out
+    assert out.startswith(lscat.CLEAR) and out.count("a=T") == 10
+
+    assert viewport.scroll(1)
+    assert capsys.readouterr().out.count("a=T") == 10
+    assert not viewport.scroll(1)  # Already at the last page
+
+    # Scrolling back only places them again
+    assert viewport.scroll(-1)
+    out = capsys.readouterr().out
+    assert out.count("a=T") == 0 and out.count("a=p") == 10
+    # Erasing the screen or scrollback would make kitty free the held images
+    assert "\x1b[2J" not in out and "\x1b[3J" not in out
+
+
+def test_encode():
+    image = Image.new("RGB", (40, 30), (255, 0, 0))
+    data, controls = lscat.encode(image, "zlib")
+    assert controls == {"f": 24, "s": 40, "v": 30, "o": "z"}
+    assert zlib.decompress(data) == image.tobytes()
+
+    data, controls = lscat.encode(image.convert("LA"), "zlib")
+    assert controls["f"] == 32 and len(zlib.decompress(data)) == 40 * 30 * 4
+
+    assert lscat.encode(image, "png")[1] == {"f": 100}
+    smallest = lscat.encode(image, "smallest")[0]
+    assert len(smallest) == min(len(lscat.encode(image, "zlib")[0]),
+                                len(lscat.encode_png(image, level=6)))
+    assert "o=z" in lscat.show(image, 1, 0, 0, payload="zlib")
+
+
+def test_rendition(tmp_path):
+    original = tmp_path / "large.png"
+    Image.new("RGB", (400, 600)).save(original)
+
+    assert lscat.rendition(original, (40, 60)).size == (40, 60)
+    path = lscat.rendition_path(original, (40, 60))
+    assert os.path.isfile(path) and Image.open(original).size == (400, 600)
+
+    # Reused, until the window size changes
+    mtime = os.path.getmtime(path)
+    assert lscat.rendition(original, (40, 60)).size == (40, 60)
+    assert os.path.getmtime(path) == mtime
+    assert lscat.rendition(original, (20, 30)).size == (20, 30)
+    assert os.listdir(tmp_path / ".display") == ["large.png.20x30.png"]
+
+    # Not stored if it's the same size
+    assert lscat.rendition(original, (400, 600)).size == (400, 600)
+    assert len(os.listdir(tmp_path / ".display")) == 1
+
+    # JPEGs stay JPEGs; titles can have glob characters
+    titled = tmp_path / "001_[x]*?.jpg"
+    Image.new("RGB", (400, 600)).save(titled)
+    lscat.rendition(titled, (40, 60))
+    lscat.rendition(titled, (20, 30))
+    assert sorted(os.listdir(tmp_path / ".display")) == [
+        "001_[x]*?.jpg.20x30.jpg", "large.png.20x30.png"]
+    assert Image.open(lscat.rendition_path(titled, (20, 30))).format == "JPEG"
+
+
+def test_tiles(tmp_path):
+    original = tmp_path / "huge.png"
+    image = Image.effect_noise((300, 200), 50).convert("RGBA")
+    image.save(original)
+
+    tiles = lscat.Tiles(original, tile_px=64, max_tiles=4)
+    assert tiles.level_size(0) == (300, 200) and tiles.level_size(3) == (38, 25)
+
+    # Stitched from 4 tiles, and the same as cropping the full image
+    view = tiles.view(0, (50, 50, 150, 100))
+    assert view.size == (100, 50)
+    assert view.tobytes() == image.crop((50, 50, 150, 100)).tobytes()
+    assert len(tiles._cache) == 4
+
+    assert tiles.view(1, (0, 0, 150, 100)).size == (150, 100)
+    assert len(tiles._cache) == 4  # Least recently used ones dropped
+    assert sorted(os.listdir(next((tmp_path / ".tiles").iterdir()))) == ["0", "1"]
+    # Made from the tiles of level 0
+    assert tiles.view(2, (0, 0, 75, 50)).size == (75, 50)
+
+
+def test_tiles_jpeg(tmp_path):
+    original = tmp_path / "huge.jpg"
+    Image.effect_noise((300, 200), 50).convert("RGB").save(original, quality=80)
+
+    # Decoded into a mapped file, and stored losslessly: the same pixels
+    tiles = lscat.Tiles(original, tile_px=64)
+    with Image.open(original) as image:
+        expected = image.crop((10, 20, 250, 180)).tobytes()
+    assert tiles.view(0, (10, 20, 250, 180)).tobytes() == expected
+    assert tiles.view(3, (0, 0, 38, 25)).size == (38, 25)
+
+
+def test_zoom(tmp_path, monkeypatch):
+    monkeypatch.setattr(lscat, "terminal_geometry", lambda: ((100, 30), (1000, 600)))
+    monkeypatch.setattr(lscat, "cell_size", lambda: (10, 20))
+    original = tmp_path / "huge.png"
+    Image.new("RGB", (4000, 3000)).save(original)
+
+    zoom = lscat.Zoom(original)  # Window is 1000x540
+    assert zoom.fit_level == 3 and zoom.level == 2 and zoom.zoomed()
+    assert zoom.box() == (0, 105, 1000, 645)  # Centered in the 1000x750 level
+
+    zoom.pan(-10, -10)  # Stops at the top left corner
+    assert zoom.box() == (0, 0, 1000, 540)
+    zoom.pan(1, 1)  # The level is only as wide as the window
+    assert zoom.box() == (0, 135, 1000, 675)
+
+    zoom.zoom(5)
+    assert zoom.level == 0
+    zoom.zoom(-5)
+    assert not zoom.zoomed()
+
+
+def test_zoom_from_gallery(tmp_path, monkeypatch):
+    monkeypatch.setattr(lscat, "terminal_geometry", lambda: ((100, 30), (1000, 600)))
+    monkeypatch.setattr(lscat, "cell_size", lambda: (10, 20))
+    monkeypatch.setattr(ui, "KONEKODIR", str(tmp_path))
+    shown = []
+    monkeypatch.setattr(lscat, "show_single", lambda path, **_: shown.append(path))
+    monkeypatch.setattr(lscat.Zoom, "render", lambda self: shown.append(self))
+
+    post_json = data.GalleryJson(page_json).current_illusts()[0]
+    idata = data.ImageJson(post_json, post_json.id)
+    # Where display_image puts it, not in idata.large_dir
+    displayed = tmp_path / str(idata.artist_user_id) / "1" / "large" / idata.filename
+    displayed.parent.mkdir(parents=True)
+    Image.new("RGB", (4000, 3000)).save(displayed, "JPEG")
+
+    image = ui.Image(post_json.id, idata, 1, False, str(displayed))
+    image.zoom(1)
+    assert image._zoom and shown == [image._zoom]
+    image.zoom(-1)
+    assert not image._zoom and shown[-1] == str(displayed)
+
+
+def test_compact_records():
+    gdata = data.GalleryJson(page_json)
+    illusts = gdata.current_illusts()
+    # Reads the same as the json, for everything that uses it
+    assert pure.post_titles_in_page(illusts) == pure.post_titles_in_page(page_illusts)
+    assert pure.medium_urls(illusts) == pure.medium_urls(page_illusts)
+    assert pure.page_urls_in_post(illusts[14], "large") == \
+        pure.page_urls_in_post(page_illusts[14], "large")
+    assert illusts[0]["user"]["id"] == page_illusts[0]["user"]["id"]
+    assert illusts[0].id == gdata.image_id(1, 0) == page_illusts[0]["id"]
+    assert gdata.next_url(1) == page_json["next_url"]
+    assert not hasattr(illusts[0], "__dict__")
+    with pytest.raises(KeyError):
+        illusts[0]["caption"]
+
+
+def test_page_cache():
+    fetched = []
+
+    def refetch(key):
+        fetched.append(key)
+        return f"page {key}"
+
+    pages = data.PageCache(refetch, max_pages=2, pinned=("1",))
+    for key in ("1", "2", "3", "4"):
+        pages[key] = f"page {key}"
+    assert pages.in_memory() == ["1", "4"]  # 1 is pinned
+    assert len(pages) == 4 and "2" in pages and "5" not in pages
+
+    assert pages["2"] == "page 2" and fetched == ["2"]  # Refetched
+    assert pages.in_memory() == ["1", "2"]
+    with pytest.raises(KeyError):
+        pages["5"]
+
+    pages.clear()
+    assert list(pages.keys()) == ["1"]
+
+
+def test_gallery_json_refetch():
+    second = dict(page_json, next_url=None)
+    gdata = data.GalleryJson(page_json, fetch=lambda url: second, max_pages=2)
+    gdata.add_page(2, second)
+    gdata.add_page(3, second)
+    assert gdata.all_pages_cache.in_memory() == ["1", "3"]
+    assert gdata.next_url(2) is None  # Refetched from page 1's next_url
+    assert gdata.current_page(1)["next_url"] == page_json["next_url"]
+    assert list(gdata.cached_pages()) == ["1", "2", "3"]
+
+
+def test_illust_table():
+    gdata = data.GalleryJson(page_json)
+    gdata.add_page(2, page_json)  # Already seen, not added again
+    table = gdata.table
+    assert len(table) == 30 and table.pages[14] == 1 and table.positions[14] == 14
+    assert table.tags(7) == ["C97", "御坂美琴"]
+
+    multi = table.select(multi_page=True)
+    assert multi == [14, 25]
+    assert table.sort(multi, "pages") == [25, 14]
+    assert table.select(tags=["moe"]) == [1, 29]  # Substring, ignoring case
+    assert table.select(tags=["moe", "2020"]) == [1]
+    assert table.select(min_bookmarks=5000) == [23]
+    assert table.select(user_id=1) == []
+    assert table.sort(table.select(tags=["水着"]))[0] == 21
+
+
+def test_parse_filter():
+    assert pure.parse_filter("multi tag:a tag:b bookmarks:10 user:2 sort:id") == (
+        {"tags": ["a", "b"], "multi_page": True, "min_bookmarks": 10, "user_id": 2},
+        "id",
+    )
+    assert pure.parse_filter("") == ({"tags": []}, "bookmarks")
+    with pytest.raises(ValueError):
+        pure.parse_filter("bookmarks:many")
+
+
+class SnapshotView:
+    def __init__(self, mode, gdata):
+        self.mode = mode
+        self.data = gdata
+
+    def snapshot(self):
+        state, sections = self.data.snapshot()
+        state["page_num"] = 3
+        return self.mode, state, sections
+
+
+def test_session_gallery(tmp_path):
+    second = dict(page_json, next_url=None)
+    gdata = data.GalleryJson(page_json, fetch=lambda url: second, max_pages=2)
+    gdata.add_page(2, second)
+    gdata.add_page(3, second)  # Evicts page 2
+    session.track(SnapshotView("5", gdata))
+    session.save(tmp_path / "session")
+
+    saved = session.load(tmp_path / "session")
+    assert saved.mode == "5" and saved.state["page_num"] == 3
+    restored = data.GalleryJson.restore(saved)
+    assert restored.all_pages_cache.in_memory() == ["1"]  # Read when used
+    assert restored.titles == gdata.titles
+    assert restored.image_id(3, 0) == page_illusts[0]["id"]
+    assert restored.next_url(3) is None
+    assert list(restored.cached_pages()) == ["1", "2", "3"]
+    with pytest.raises(KeyError):
+        restored.current_page(2)  # Wasn't in memory, and can't be fetched
+    assert len(restored.table) == 30
+
+    # Saving again keeps the pages that weren't read
+    session.track(SnapshotView("5", data.GalleryJson.restore(saved)))
+    session.save(tmp_path / "session")
+    assert "page 3" in session.load(tmp_path / "session")
+
+
+def test_session_invalid(tmp_path):
+    assert session.load(tmp_path / "missing") is None
+    (tmp_path / "session").write_bytes(b"not a session")
+    assert session.load(tmp_path / "session") is None
+
+
+def test_user_json_restore():
+    raw = {"next_url": "next", "user_previews": [
+        {"user": {"id": i, "name": f"artist{i}",
+                  "profile_image_urls": {"medium": f"https://x/{i}.jpg"}},
+         "illusts": [{"id": 100 + i,
+                      "image_urls": {"square_medium": f"https://x/{100 + i}_p0.jpg"}}]}
+        for i in range(3)
+    ]}
+    udata = data.UserJson(raw, 1)
+    restored = data.UserJson.restore(udata.snapshot())
+    assert restored.names(1) == ["artist0", "artist1", "artist2"]
+    assert restored.artist_user_id(1, 2) == 2
+    assert restored.all_names(1) == udata.all_names(1)
+    assert udata.manifest(1)[0] == {"id": 0, "url": "https://x/0.jpg",
+                                    "file": "000_artist0.jpg"}
+    assert udata.manifest(1)[3] == {"id": 100, "url": "https://x/100_p0.jpg",
+                                    "file": "previews/003_100_p0.jpg"}
+    assert restored.next_url == "next"
+
+
+def test_users_download_failure(tmp_path, monkeypatch, capsys):
+    def request(offset):
+        return {"next_url": "next", "user_previews": [
+            {"user": {"id": offset + i, "name": f"artist{offset + i}",
+                      "profile_image_urls": {"medium": f"https://x/{offset + i}.jpg"}},
+             "illusts": []}
+            for i in range(3)
+        ]}
+
+    failing = True
+
+    def protected_download(url, path):
+        if failing:
+            raise ConnectionError
+        (Path(path) / pure.split_backslash_last(url)).write_text(url)
+
+    shown = []
+    monkeypatch.setattr(ui, "KONEKODIR", str(tmp_path))
+    monkeypatch.setattr(ui.SearchUsers, "_pixivrequest", lambda self, offset: request(offset))
+    monkeypatch.setattr(ui.Users, "_show_page", lambda self: shown.append(self._page_num))
+    monkeypatch.setattr(ui.Users, "_top_up", lambda self: None)
+    monkeypatch.setattr(session, "track", lambda view: None)
+    monkeypatch.setattr(session, "checkpoint", lambda: None)
+    monkeypatch.setattr(api.myapi, "protected_download", protected_download)
+
+    users = ui.SearchUsers("x")
+    users.start()  # Doesn't quit koneko, and there's no page to show
+    assert shown == [] and "Page 1 failed to download" in capsys.readouterr().out
+
+    failing = False
+    users.start()
+    assert shown == [1]
+
+    failing = True
+    users._jump(5)  # Stays on the previous page
+    assert shown == [1, 1] and users._page_num == 1
+    assert users.download_path.endswith("/1")
+    assert "Page 5 failed to download" in capsys.readouterr().out
+
+
+def test_parse_json():
+    content = json.dumps(page_json).encode()
+    parsed = api.parse_json(content)
+    assert parsed["illusts"] == page_illusts and parsed["next_url"] == page_json["next_url"]
+    assert type(parsed["illusts"][0]) is dict  # As decoded, for data.py
+    # Reads like pixivpy's JsonDict
+    assert parsed.illusts[0].user.id == page_illusts[0]["user"]["id"]
+    assert parsed.illusts[0].meta_pages == [] and parsed.missing is None
+    assert parsed.get("missing", 1) == 1 and "illusts" in parsed
+    assert data.GalleryPage(parsed)["illusts"][0].id == page_illusts[0]["id"]
+
+
+def test_prefetch(tmp_path):
+    release = threading.Event()
+    for name in ("a.jpg", "b.jpg"):
+        (tmp_path / name).write_bytes(b"x" * 10)
+
+    def fetch(progress):
+        progress.fetched(page_json)
+        progress.expect(2)
+        progress.add(str(tmp_path / "a.jpg"))
+        release.wait()
+        progress.add(str(tmp_path / "b.jpg"))
+        progress.add(None)  # Last call from download_page
+        return page_json
+
+    prefetch = ui.Prefetch(fetch)
+    assert prefetch.page() is page_json  # Before the images
+    threading.Timer(0.2, release.set).start()
+    assert prefetch.wait() is page_json  # Waits for the rest
+    assert (prefetch.done, prefetch.total, prefetch.bytes) == (2, 2, 20)
+
+    def fail(progress):
+        raise ConnectionError
+
+    failed = ui.Prefetch(fail)
+    with pytest.raises(ConnectionError):
+        failed.wait()
+    with pytest.raises(ConnectionError):
+        failed.page()
+
+
+def test_prefetch_cancelled_before(monkeypatch, capsys):
+    monkeypatch.setattr(ui, "PREFETCHES", {})
+    gallery = object.__new__(ui.ArtistGallery)
+    gallery._main_path = "/a"
+    gallery.data = data.GalleryJson(page_json)
+
+    def cancelled(progress):
+        raise ui.futures.CancelledError  # The page before's was cancelled
+
+    def top_up():
+        ui.PREFETCHES["/a/2/"] = ui.Prefetch(lambda progress: page_json)
+
+    monkeypatch.setattr(gallery, "_top_up", top_up)
+    ui.PREFETCHES["/a/2/"] = ui.Prefetch(cancelled)
+    assert gallery._finish_prefetch(2)  # Prefetched again, not a failure
+    assert "2" in gallery.data.cached_pages()
+    assert "failed" not in capsys.readouterr().out
+
+
+def test_lookahead_budget(monkeypatch):
+    release = threading.Event()
+    monkeypatch.setattr(ui.Prefetch, "POOL", ui.futures.ThreadPoolExecutor(1))
+    monkeypatch.setattr(ui, "PREFETCHES", {})
+    monkeypatch.setattr(ui, "LOOKAHEAD_BYTES", 250)
+
+    def fetch(progress):
+        release.wait()
+
+    assert ui.within_budget("/a/", 100)  # The nearest page always can
+    ui.PREFETCHES["/a/2/"] = ui.Prefetch(fetch)  # Running
+    ui.PREFETCHES["/a/3/"] = ui.Prefetch(fetch)  # Waiting for a worker
+    ui.PREFETCHES["/b/2/"] = ui.Prefetch(fetch)
+    assert not ui.within_budget("/a/", 100)  # Counts 100 for each in flight
+    assert ui.within_budget("/a/", 50)
+
+    ui.focus_prefetches("/a/")  # Other views wait behind /a/
+    assert list(ui.PREFETCHES) == ["/a/2/", "/a/3/"]
+    release.set()
+    ui.drop_prefetches("/a/")
+    assert not ui.PREFETCHES
+
+
+def test_fan_out(monkeypatch):
+    monkeypatch.setattr(ui, "FAN_OUT", 2)
+    requested = []
+
+    def request(offset):
+        """A list of 70 users"""
+        requested.append(offset)
+        users = max(0, min(30, 70 - offset))
+        return {"user_previews": [{}] * users,
+                "next_url": "next" if offset + 30 < 70 else None}
+
+    pages = ui.fan_out(request, range(1, 20))
+    assert list(pages) == [1, 2, 3]
+    assert sorted(requested) == [0, 30, 60, 90]  # Two batches
+
+    requested.clear()
+    pages = ui.fan_out(request, range(4, 8))
+    assert list(pages) == [4] and not pages[4]["user_previews"]
+    assert sorted(requested) == [90, 120]
+
+    def error(offset):
+        """What pixiv replies to an offset that's too large"""
+        if offset >= 60:
+            return {"error": {"message": "offset must be no more than 5000"}}
+        return request(offset)
+
+    pages = ui.fan_out(error, range(2, 6))
+    assert list(pages) == [2, 3] and "error" in pages[3]